@@ -19,16 +19,30 @@ from time import time, sleep
 from random import randint, uniform
 import math
 import random
+import threading
+from functools import wraps
 
 from libs import earth
 from libs import projections as pr
 from libs import verbose as vb
 from auditor_db import AuditorDB
-from auditor_user import AuditorUser
+from auditor_user import UserRegistry
+from auditor_scheduler import travel_wait
 from auditor_exception import AuditorException, AuditorExceptionUnknown
-import auditor_discovery_attack
 import auditor_constants as const
 
+def _flushes_users(test):
+    """Writes the queries and location of the users to the db once @test
+    is over, even if it failed
+    """
+    @wraps(test)
+    def flushed(self, *args, **kwargs):
+        try:
+            return test(self, *args, **kwargs)
+        finally:
+            self.registry.flush()
+    return flushed
+
 class Auditor(object):
     """Class implementing basic auditing of the service
 
@@ -36,6 +50,10 @@ class Auditor(object):
         auditor_get_distance(user_a, user_b)
         auditor_set_location(user, lat, lon)
 
+    and may optionally implement
+        auditor_get_distances(user_a, users, loc)
+    for services returning the distances from many users in a single call.
+
     Each of these functions should raise an Exception in case of an error
     otherwise return its result and the number of queries required to perform
     the operation in a tuple of the form (result, queries)
@@ -72,8 +90,9 @@ class Auditor(object):
         self.users = user_list
 
         # insert all users in database if they don't exist
-        for user in user_list:
-            self._db.insert_user(user, self.service_id)
+        self._db.insert_users(user_list, self.service_id)
+        # AuditorUser instances shared by all tests
+        self.registry = UserRegistry(self._db, self.service_id)
 
         # set verbose output
         self.verbose = verbose
@@ -95,6 +114,17 @@ class Auditor(object):
         self.attackers = None
         self.attacker = None
         self.victim = None
+        # the AuditorException raised by the last failed query of each
+        # thread, so that the caller can tell what kind of failure it was
+        self._failures = threading.local()
+        # functions called with the AuditorUser instance of every user that
+        # is moved, e.g. to invalidate cached oracle responses
+        self.move_hooks = []
+        # the ResponseCache shared by the proximity oracles of the auditor
+        self.response_cache = None
+        # the last query id handed out and its lock
+        self._query_id = 0
+        self._query_id_lock = threading.Lock()
 
         #
         #
@@ -194,6 +224,7 @@ class Auditor(object):
     #
     #
 
+    @_flushes_users
     def test_speed_limit(self, users=None):
         """Run a speed limit test binary searching for the max allowed speed
         """
@@ -203,7 +234,7 @@ class Auditor(object):
         if users is None:
             users = self._db.get_ordered_users()
 
-        self.attackers = [AuditorUser(self.service_id, u) for u in users]
+        self.attackers = self.registry.get_many(users)
         self.attacker = self.attackers.pop()
 
         self._db.insert_test("speed_limit")
@@ -297,6 +328,7 @@ class Auditor(object):
     #
     #
 
+    @_flushes_users
     def test_query_limit(self, users=None, rate_limit_only=False, rate=2):
         """Initializes a test for speed constraints
         @users: a user list to be used for this experiment
@@ -314,7 +346,7 @@ class Auditor(object):
         if len(users) == 1:
             raise SystemExit("Not enough users! At least two users required")
 
-        self.attackers = [AuditorUser(self.service_id, u) for u in users]
+        self.attackers = self.registry.get_many(users)
         self.attacker = self.attackers.pop()
         victim = self.attackers.pop(0)
 
@@ -461,9 +493,25 @@ class Auditor(object):
     #
     #
 
+    @_flushes_users
     def test_dudp_attack(self, disk_radii, victim=None, users=None,
-                         kml=None, grid=20):
+                         kml=None, grid=20, oracle_error=None,
+                         local_proj=False, cut_method=const.CUT.RASTER,
+                         raster_resolution=None,
+                         artifact_level=const.ARTIFACT.ALL,
+                         artifact_format=const.ARTIFACT_FORMAT.KML):
         """Run the DUDP attack and set the accuracy in the Auditor class
+
+        If @oracle_error is given, oracle answers are assumed to be wrong
+        with that probability and a noise tolerant estimator is used.
+        If @local_proj is set, the attack runs on a projection centred at
+        the search area instead of self.proj.
+        @cut_method (one of const.CUT) selects the engine that finds the
+        cuts of the binary phase, and if @raster_resolution is given the
+        active region is kept as a raster mask with cells of that size in m.
+        @artifact_level (one of const.ARTIFACT) sets which geometries are
+        written for each step, OFF writing none, and @artifact_format (one
+        of const.ARTIFACT_FORMAT) the format they are written in.
         """
         # TODO add documentation & user checking add check for no of users
         # but provision for the case where the auditor supplied victim and
@@ -474,17 +522,17 @@ class Auditor(object):
             users = self._db.get_ordered_users()
 
         if victim is not None:
-            self.victim = AuditorUser(self.service_id, victim)
+            self.victim = self.registry.get(victim)
             # make sure that victim is not in users
             #users.remove(victim)
 
-            # and create instances of AuditorUser for attackers
-            self.attackers = [AuditorUser(self.service_id, u) for u in users]
+            # and get the AuditorUser instances of the attackers
+            self.attackers = self.registry.get_many(users)
             self.attacker = self.attackers.pop()
 
         else:
-            # and create instances of AuditorUser for attackers
-            self.attackers = [AuditorUser(self.service_id, u) for u in users]
+            # and get the AuditorUser instances of the attackers
+            self.attackers = self.registry.get_many(users)
             self.attacker = self.attackers.pop()
             # pick the guy with the most queries to be the victim
             self.victim = self.attackers.pop(0)
@@ -513,25 +561,55 @@ class Auditor(object):
         self.query_limit = self.absq_limit
 
 
-        disc_attack = auditor_discovery_attack.DiscoveryAttack(self,
-                                                               self.attackers,
-                                                               self.attacker,
-                                                               self.victim,
-                                                               self.proj,
-                                                               self.oracle,
-                                                               self.test_id,
-                                                               self.__serv_name,
-                                                               "dudp",
-                                                               self.verbose,
-                                                               self.query_limit,
-                                                               self.speed_limit)
-
-        self.dudp_accuracy = disc_attack.dudp_attack(disk_radii, kml, grid)
+        # the attack pulls in the geometry and kml libraries, only load
+        # it when an attack is run
+        import auditor_discovery_attack
+        disc_attack = auditor_discovery_attack.DiscoveryAttack(
+            self,
+            self.attackers,
+            self.attacker,
+            self.victim,
+            self.proj,
+            self.oracle,
+            self.test_id,
+            self.__serv_name,
+            "dudp",
+            self.verbose,
+            kml=kml,
+            query_lim=self.query_limit,
+            speed_limit=self.speed_limit,
+            local_proj=local_proj,
+            cut_method=cut_method,
+            raster_resolution=raster_resolution,
+            artifact_level=artifact_level,
+            artifact_format=artifact_format)
+
+        self.dudp_accuracy = disc_attack.dudp_attack(disk_radii,
+                                                     kml,
+                                                     grid,
+                                                     oracle_error)
 
 
+    @_flushes_users
     def test_rudp_attack(self, rounding_classes, victim=None, users=None,
-                         kml=None, grid=20):
+                         kml=None, grid=20, oracle_error=None,
+                         local_proj=False, ring_attackers=1,
+                         cut_method=const.CUT.RASTER, raster_resolution=None,
+                         artifact_level=const.ARTIFACT.ALL,
+                         artifact_format=const.ARTIFACT_FORMAT.KML):
         """Run the RUDP attack and set the accuracy in the Auditor class
+
+        If @oracle_error is given, oracle answers are assumed to be wrong
+        with that probability and a noise tolerant estimator is used.
+        If @local_proj is set, the attack runs on a projection centred at
+        the search area instead of self.proj.
+        @cut_method and @raster_resolution select the cut engine and the
+        representation of the active region, and @artifact_level and
+        @artifact_format the geometries written for each step, as in
+        test_dudp_attack.
+        If @ring_attackers is at least 3, that many attackers are placed
+        around the search area and queried concurrently for the first
+        estimate.
         """
 
         vb.vb_print(self.verbose, "Testing accuracy of RUDP attack")
@@ -540,17 +618,17 @@ class Auditor(object):
             users = self._db.get_ordered_users()
 
         if victim is not None:
-            self.victim = AuditorUser(self.service_id, victim)
+            self.victim = self.registry.get(victim)
             # make sure that victim is not in users
             #users.remove(victim)
 
-            # and create instances of AuditorUser for attackers
-            self.attackers = [AuditorUser(self.service_id, u) for u in users]
+            # and get the AuditorUser instances of the attackers
+            self.attackers = self.registry.get_many(users)
             self.attacker = self.attackers.pop()
 
         else:
-            # and create instances of AuditorUser for attackers
-            self.attackers = [AuditorUser(self.service_id, u) for u in users]
+            # and get the AuditorUser instances of the attackers
+            self.attackers = self.registry.get_many(users)
             self.attacker = self.attackers.pop()
             # pick the guy with the most queries to be the victim
             self.victim = self.attackers.pop(0)
@@ -573,22 +651,103 @@ class Auditor(object):
         if self.query_limit is None:
             query_limit = self.absq_limit
 
-        disc_attack = auditor_discovery_attack.DiscoveryAttack(self,
-                                                               self.attackers,
-                                                               self.attacker,
-                                                               self.victim,
-                                                               self.proj,
-                                                               self.oracle,
-                                                               self.test_id,
-                                                               self.__serv_name,
-                                                               "rudp",
-                                                               self.verbose,
-                                                               self.query_limit,
-                                                               self.speed_limit)
+        # the attack pulls in the geometry and kml libraries, only load
+        # it when an attack is run
+        import auditor_discovery_attack
+        disc_attack = auditor_discovery_attack.DiscoveryAttack(
+            self,
+            self.attackers,
+            self.attacker,
+            self.victim,
+            self.proj,
+            self.oracle,
+            self.test_id,
+            self.__serv_name,
+            "rudp",
+            self.verbose,
+            kml=kml,
+            query_lim=self.query_limit,
+            speed_limit=self.speed_limit,
+            local_proj=local_proj,
+            cut_method=cut_method,
+            raster_resolution=raster_resolution,
+            artifact_level=artifact_level,
+            artifact_format=artifact_format)
 
         self.rudp_accuracy = disc_attack.rudp_attack(rounding_classes,
                                                      kml,
-                                                     grid)
+                                                     grid,
+                                                     oracle_error,
+                                                     ring_attackers)
+
+    @_flushes_users
+    def test_dudp_multi_attack(self, disk_radii, victims=None, victims_no=2,
+                               users=None, kml=None, local_proj=False,
+                               artifact_level=const.ARTIFACT.ALL,
+                               artifact_format=const.ARTIFACT_FORMAT.KML):
+        """Run the DUDP attack against several victims at once, sharing the
+        attacker placements between them
+
+        Args:
+            disk_radii: the list of available radii in km
+            victims:    the users to be used as victims. If None, the
+                        @victims_no users with the most queries are used
+            users:      the users to be used as attackers
+            artifact_level, artifact_format: the geometries written for
+                        each step, as in test_dudp_attack
+
+        Returns:
+            the accuracy in m of the attack for each victim, None for
+            victims that were not found
+        """
+        vb.vb_print(self.verbose, "Testing accuracy of multi-victim DUDP")
+
+        if type(disk_radii) != list:
+            raise TypeError("Expecting a list of radii in km")
+
+        if len(disk_radii) == 0:
+            raise SystemExit("At least one radius in km is required!")
+
+        if users is None:
+            users = self._db.get_ordered_users()
+
+        self.attackers = self.registry.get_many(users)
+        self.attacker = self.attackers.pop()
+
+        if victims is not None:
+            victim_list = self.registry.get_many(victims)
+        else:
+            if len(self.attackers) <= victims_no:
+                raise SystemExit("Not enough users for the victims!")
+            # pick the guys with the most queries to be the victims
+            victim_list = [self.attackers.pop(0) for _ in range(victims_no)]
+
+        self._db.insert_test("dudp_multi")
+        self.test_id = self._db.get_test_id("dudp_multi")
+
+        # FIXME check query rate limiting for both dudp and rudp
+        self.query_limit = self.absq_limit
+
+        import auditor_discovery_attack
+        disc_attack = auditor_discovery_attack.MultiDiscoveryAttack(
+            self,
+            self.attackers,
+            self.attacker,
+            victim_list,
+            self.proj,
+            self.oracle,
+            self.test_id,
+            self.__serv_name,
+            "dudp_multi",
+            self.verbose,
+            kml=kml,
+            query_lim=self.query_limit,
+            speed_limit=self.speed_limit,
+            local_proj=local_proj,
+            artifact_level=artifact_level,
+            artifact_format=artifact_format)
+
+        return disc_attack.dudp_attack(disk_radii)
 
     #
     #
@@ -596,6 +755,7 @@ class Auditor(object):
     #
     #
 
+    @_flushes_users
     def test_location_verification(self, users=None):
         """Checks whether the service verifies the location
         of a user when they perform a query
@@ -607,7 +767,7 @@ class Auditor(object):
         if len(users) < 2:
             raise SystemExit("Not enough users! Three users required")
 
-        user_list = [AuditorUser(self.service_id, u) for u in users]
+        user_list = self.registry.get_many(users)
 
 
         vb.vb_print(self.verbose, "Examining if service verifies coordinates")
@@ -672,21 +832,45 @@ class Auditor(object):
     #
     #
 
-    def _get_max_distance(self, auditor_user):
-        """Returns the maximum distance that a user is allowed to travel
-        given the speed constraints of the service and the last update of
-        their location
+    @property
+    def last_failure(self):
+        """The AuditorException raised by the last failed query of the
+        calling thread, None if there was none
         """
-        if self.speed_limit is not None:
-            # if we have a speed limit check if the last update of the location
-            # allows us to move at current distance
-            time_since_last_update = time() - auditor_user.last_updated
-            # since distance is in km/h divide time (in sec) with 3600 to get h
-            max_distance = self.speed_limit * (time_since_last_update / 3600)
-        else:
-            max_distance = float('inf')
+        return getattr(self._failures, "exception", None)
+
+    @last_failure.setter
+    def last_failure(self, failure):
+        self._failures.exception = failure
 
-        return max_distance
+    def next_query_id(self):
+        """Returns a new query id: the current time in sec, or the id after
+        the last one if that was already handed out in this second, so that
+        queries issued at once (e.g. by concurrent attackers) get distinct
+        primary keys
+        """
+        with self._query_id_lock:
+            self._query_id = max(self._query_id + 1, int(time()))
+            return self._query_id
+
+    def _moved(self, auditor_user):
+        """Notifies the move hooks that @auditor_user has moved
+        """
+        for hook in self.move_hooks:
+            hook(auditor_user)
+
+    def _wait_for_move(self, auditor_user, lat, lon):
+        """Sleeps until @auditor_user can move to [@lat, @lon] without
+        exceeding the speed limit of the service, given the time of their
+        last move
+        """
+        wait = travel_wait(auditor_user, lat, lon, self.speed_limit)
+        if wait > 0:
+            vb.vb_print(self.verbose,
+                        "Waiting " + str(int(wait) + 1) + "s to move user",
+                        None,
+                        True)
+            sleep(wait + 1)
 
     def auditor_handled_place_at_coords(self, user, lat, lon, test_id,
                                        query_id=None):
@@ -717,30 +901,14 @@ class Auditor(object):
         if not (isinstance(lat, float) and isinstance(lon, float)):
             raise TypeError("lat and lon parameters should be of type float!")
 
-        # get the max distance the user is allowed to travel
-        max_distance = self._get_max_distance(user)
-
-        # get the distance of the current location with the new location
-        if user.loc[0] is not None and user.loc[1] is not None:
-            dist = earth.distance_on_unit_sphere(user.loc[0],
-                                                 user.loc[1],
-                                                 lat,
-                                                 lon)
-        else:
-            # it's our first update
-            dist = 0
-
         # If we have a speed limit and the distance is bigger than what
         # we are allowed to cross, sleep until we are allowed
-        if dist > max_distance:
-            sleep_time = (dist - max_distance) / self.speed_limit
-            sleep(sleep_time + 1)
+        self._wait_for_move(user, lat, lon)
 
         try:
-            # given that the clocks won't change and we don't
-            # run stuff in parallel, have time as primary key
+            # time based primary key, unique even for concurrent queries
             if query_id is None:
-                query_id = int(time())
+                query_id = self.next_query_id()
 
             # if we have full logging create query record
             # create it here in case any exception is raised
@@ -770,7 +938,8 @@ class Auditor(object):
             if result is False and self.logging == const.LOG.ALL:
                 self._db.log_query_fail(query_id)
 
-        except AuditorException:
+        except AuditorException as failure:
+            self.last_failure = failure
             if self.logging == const.LOG.ALL:
                 self._db.log_query_fail(query_id)
                 # handle any data that has been passed by the user
@@ -786,7 +955,9 @@ class Auditor(object):
             raise AuditorExceptionUnknown(str(exception), user.user_id)
 
         user.update_queries(queries)
-        user.loc = [lat, lon]
+        if result:
+            user.update_location(lat, lon)
+            self._moved(user)
 
         return (result, queries)
 
@@ -816,26 +987,20 @@ class Auditor(object):
             AuditorException(with optional log data) in case an error occurs.
         """
 
-        # get the max distance the user is allowed to travel
-        max_distance = self._get_max_distance(user)
-
-        # If we have a speed limit and the distance is bigger than what
-        # we are allowed to cross, sleep until we are allowed
-        if dist > max_distance:
-            sleep_time = (dist - max_distance) / self.speed_limit
-            sleep(sleep_time + 1)
-
         # find new position at distance and angle
         new_pos = earth.point_on_earth(user.loc[0],
                                        user.loc[1],
                                        dist,
                                        bear)
 
+        # If we have a speed limit and the distance is bigger than what
+        # we are allowed to cross, sleep until we are allowed
+        self._wait_for_move(user, new_pos[0], new_pos[1])
+
         try:
-            # given that the clocks won't change and we don't
-            # run stuff in parallel, have time as primary key
+            # time based primary key, unique even for concurrent queries
             if query_id is None:
-                query_id = int(time())
+                query_id = self.next_query_id()
 
             # if we have full logging create query record
             # create it here in case any exception is raised
@@ -865,7 +1030,8 @@ class Auditor(object):
             if result is False and self.logging == const.LOG.ALL:
                 self._db.log_query_fail(query_id)
 
-        except AuditorException:
+        except AuditorException as failure:
+            self.last_failure = failure
             if self.logging == const.LOG.ALL:
                 self._db.log_query_fail(query_id)
                 # handle any data that has been passed by the user
@@ -880,7 +1046,9 @@ class Auditor(object):
 
         # update user info
         user.update_queries(queries)
-        user.loc = new_pos
+        if result:
+            user.update_location(new_pos[0], new_pos[1])
+            self._moved(user)
 
         return (result, queries)
 
@@ -902,10 +1070,9 @@ class Auditor(object):
             perform the update.
         """
         try:
-            # given that the clocks won't change and we don't
-            # run stuff in parallel, have time as primary key
+            # time based primary key, unique even for concurrent queries
             if query_id is None:
-                query_id = int(time())
+                query_id = self.next_query_id()
 
             # if we have full logging create query record
             # create it here in case any exception is raised
@@ -936,7 +1103,8 @@ class Auditor(object):
             if dist is None and self.logging == const.LOG.ALL:
                 self._db.log_query_fail(query_id)
 
-        except AuditorException:
+        except AuditorException as failure:
+            self.last_failure = failure
             if self.logging == const.LOG.ALL:
                 # handle any data that has been passed by the user
                 self._db.log_query_fail(query_id)
@@ -953,6 +1121,101 @@ class Auditor(object):
 
         return (dist, queries)
 
+    def has_bulk_distances(self):
+        """Returns True if the inherited class implements
+        auditor_get_distances
+        """
+        return (self.auditor_get_distances.__func__ is not
+                Auditor.auditor_get_distances.__func__)
+
+    def auditor_handled_distances(self, user_a, users_b, test_id,
+                                  u_coords=None, query_id=None):
+        """Get the distances between user_a and each of users_b and handle
+        any possible exceptions that may be raised
+
+        If the inherited class implements auditor_get_distances all distances
+        are fetched with a single call, otherwise auditor_handled_distance is
+        called for each user.
+
+        Args:
+            user_a: AuditorUser instance performing the query
+            users_b: list of AuditorUser instances to measure the distance from
+            test_id: the id of the current test performed
+
+        Return Value:
+            Returns a tuple (@result, @queries) where @result is a list with
+            the distance in km from each of @users_b, None for the users whose
+            distance was not found. @queries is the total queries towards the
+            service required to perform the operation.
+        """
+        if not self.has_bulk_distances():
+            dists = []
+            total = 0
+            for (i, user_b) in enumerate(users_b):
+                # the primary key of a query must be unique, so only the
+                # first call uses the id that was passed
+                if i > 0 or query_id is None:
+                    query_id = self.next_query_id()
+                (dist, queries) = self.auditor_handled_distance(user_a,
+                                                                user_b,
+                                                                test_id,
+                                                                u_coords,
+                                                                query_id)
+                dists.append(dist)
+                total += queries
+            return (dists, total)
+
+        try:
+            if query_id is None:
+                query_id = self.next_query_id()
+
+            # a single record for the whole bulk query
+            if self.logging == const.LOG.ALL:
+                query_info = "auditor_get_distances "
+                query_info += str(user_a.user) + ",["
+                query_info += ",".join(str(u.user) for u in users_b) + "]"
+                self._db.insert_query(query_id,
+                                     test_id,
+                                     user_a.user_id,
+                                     user_a.service_id,
+                                     query_info)
+
+            get_dist_rspn = self.auditor_get_distances(user_a.user,
+                                                       [u.user for u in users_b],
+                                                       u_coords)
+
+            if len(get_dist_rspn) != 2:
+                raise SystemExit("auditor_get_distances must return a tuple!")
+
+            (dists, queries) = get_dist_rspn
+
+            if type(dists) != list or len(dists) != len(users_b):
+                error = "Wrong return type: Expecting a distance for each user"
+                raise TypeError(error)
+
+            # if no exception was raised but we failed log it
+            if (any(dist is None for dist in dists) and
+                    self.logging == const.LOG.ALL):
+                self._db.log_query_fail(query_id)
+
+        except AuditorException as failure:
+            self.last_failure = failure
+            if self.logging == const.LOG.ALL:
+                # handle any data that has been passed by the user
+                self._db.log_query_fail(query_id)
+                self._db.exception_recovery(query_id)
+            return ([None] * len(users_b), 1)
+        except Exception as exception:
+            # remove user from active users
+            self.users.remove(user_a.user)
+            # else raise exception and record failure
+            self._db.log_query_fail(query_id)
+            raise AuditorExceptionUnknown(str(exception), user_a.user_id)
+
+        user_a.update_queries(queries)
+
+        return (dists, queries)
+
 
     #####################################################################
     #                                                                   #
@@ -1000,6 +1263,33 @@ class Auditor(object):
 
         raise AttributeError("auditor_get_distance undefined in child class")
 
+    def auditor_get_distances(self, _user_a, _users, _user_a_loc):
+        """Get the distances of many users from _user_a as returned by the
+        service in a single call
+
+        - Optionally defined by inherited classes. Services that return a
+        list of nearby users along with their distances should implement this
+        function so that the distances from many users cost a single query.
+        If it is not defined auditor_get_distance is used for each user.
+
+        Args:
+            _user_a: user identifier as defined by the inherited class. This
+                    user issues the query
+            _users: list of user identifiers as defined by the inherited class
+            _user_a_loc: the location of user_a in format [lat, lon]
+
+        Return Value:
+            Returns a tuple (@result, @queries) where @result is a list with
+            the distance in km from each of @_users, in the same order, or None
+            for the users whose distance was not found. @queries is the total
+            queries towards the service required to perform the operation.
+
+        Raises:
+            AuditorException(with optional log data) in case an error occurs.
+        """
+
+        raise AttributeError("auditor_get_distances undefined in child class")
+
     def auditor_set_location(self, _user, _lat, _lon):
         """Set location of user
 
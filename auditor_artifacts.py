@@ -0,0 +1,198 @@
+"""Background writer of the geometries of attack steps
+"""
+from __future__ import absolute_import
+import json
+import os
+import zipfile
+from Queue import Queue
+from threading import Thread
+
+from lxml import etree
+from pykml.factory import KML_ElementMaker as KML
+from shapely import wkb
+
+from libs import projections
+from libs.kmlparser import KMLParser
+import auditor_constants as const
+
+
+class ArtifactWriter(object):
+    """Streams the geometries of an attack to a background thread
+
+    Logging a geometry only puts it in a queue, so conversion to polygons,
+    unprojection and file I/O no longer happen between service queries.
+    Depending on @fmt, all geometries of the attack end up in a single
+    kml/kmz document with a folder per kind of step, or are appended to a
+    file with one json line (id, kind and hex WKB) per step. The kml
+    document is saved whenever the queue runs empty, so a crash only loses
+    the geometries still queued.
+    """
+
+    # kinds of steps logged when only regions are requested
+    REGION_KINDS = ("inter", "ring")
+
+    def __init__(self, path, kmlparser, level=const.ARTIFACT.ALL,
+                 fmt=const.ARTIFACT_FORMAT.KML):
+        """Initializes a writer to @path (without extension)
+
+        Args:
+            @kmlparser: KMLParser whose projection is used to convert
+                        projected geometries
+            @level:     one of const.ARTIFACT
+            @fmt:       one of const.ARTIFACT_FORMAT
+        """
+        # pyproj projections are not thread safe, the writer has its own
+        self.kmlparser = KMLParser(projections.copy_proj(kmlparser.proj))
+        self.level = level
+        self.fmt = fmt
+        self.path = path + "." + fmt.lower()
+        if fmt == const.ARTIFACT_FORMAT.WKB:
+            self.path += ".jsonl"
+
+        self.outfile = None
+        self.kml = None
+        self.folders = {}
+        # geometries that could not be written
+        self.failures = 0
+        self.thread = None
+        self.queue = Queue()
+        if self.level == const.ARTIFACT.OFF:
+            return
+
+        if fmt == const.ARTIFACT_FORMAT.WKB:
+            self.outfile = open(self.path, "w")
+        else:
+            self.kml = KML.kml(KML.Document(KML.name(os.path.basename(path))))
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wants(self, kind):
+        """Returns True if steps of @kind are written at this level
+        """
+        if self.level == const.ARTIFACT.OFF:
+            return False
+        if self.level == const.ARTIFACT.REGIONS:
+            return kind.startswith(self.REGION_KINDS)
+        return True
+
+    def log(self, name, kind, geometry):
+        """Queues @geometry (projected) to be written under @name
+
+        @geometry may be a shapely geometry or any object with a to_polygon
+        method, which must not be modified afterwards.
+
+        Returns:
+            @name, or None if steps of @kind are not written
+        """
+        if not self.wants(kind) or self.thread is None:
+            return None
+        self.queue.put((name, kind, geometry))
+        return name
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+                if self.kml is not None and self.queue.empty():
+                    self._save()
+            except Exception as error:
+                # never let a broken artifact stop the writer, the failure
+                # is reported when the writer is closed
+                self.failures += 1
+                print "[artifacts] Could not write " + str(item[0])
+                print error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, name, kind, geometry):
+        if hasattr(geometry, "to_polygon"):
+            geometry = geometry.to_polygon()
+
+        if self.outfile is not None:
+            self.outfile.write(json.dumps({"id": name,
+                                           "kind": kind,
+                                           "wkb": wkb.dumps(geometry,
+                                                            hex=True)}))
+            self.outfile.write("\n")
+            self.outfile.flush()
+            return
+
+        if kind not in self.folders:
+            self.folders[kind] = KML.Folder(KML.name(kind))
+            self.kml.Document.append(self.folders[kind])
+        for placemark in self.kmlparser.placemarks(geometry, name):
+            self.folders[kind].append(placemark)
+
+    def _save(self):
+        """Writes the kml document with everything logged so far
+        """
+        data = etree.tostring(self.kml, pretty_print=True)
+        tmp = self.path + ".tmp"
+        if self.fmt == const.ARTIFACT_FORMAT.KMZ:
+            with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as kmz:
+                kmz.writestr("doc.kml", data)
+        else:
+            with open(tmp, "w") as outfile:
+                outfile.write(data)
+        os.rename(tmp, self.path)
+
+    def flush(self):
+        """Waits for all queued geometries to be written
+        """
+        if self.thread is None:
+            return
+        self.queue.join()
+
+    def close(self):
+        """Writes everything queued and stops the writer thread
+
+        Returns:
+            the number of geometries that could not be written
+        """
+        if self.thread is None:
+            return self.failures
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.kml is not None:
+                self._save()
+            if self.outfile is not None:
+                self.outfile.close()
+        return self.failures
+
+
+class StepLog(object):
+    """Incremental log of the steps of an attack
+
+    Every step is appended to @path as a json line and flushed right away,
+    so memory does not grow with the number of steps and a crash only loses
+    the step being written. Geometries are referenced by their id in the
+    artifacts of the attack instead of being embedded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.outfile = None
+
+    def append(self, stage, step):
+        """Writes @step (a dict) of the attack @stage
+        """
+        if self.outfile is None:
+            self.outfile = open(self.path, "a")
+        record = {"stage": stage}
+        record.update(step)
+        self.outfile.write(json.dumps(record) + "\n")
+        self.outfile.flush()
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
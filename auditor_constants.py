@@ -10,3 +10,18 @@ class Enum(set):
 ROUNDING = Enum(["UP", "DOWN", "BOTH"])
 # log level
 LOG = Enum(["STANDARD", "ALL"])
+# cut engine used in the binary phase of the attacks
+CUT = Enum(["AXIS", "RASTER"])
+# detail of the geometries written for each attack step: nothing, only the
+# active regions (intersections and rings) or all of them (disks as well)
+ARTIFACT = Enum(["OFF", "REGIONS", "ALL"])
+# format of the step geometries: a single kml (or zipped kmz) document
+# with a folder per kind of step, or one line of hex WKB per step
+ARTIFACT_FORMAT = Enum(["KML", "KMZ", "WKB"])
+# kind of failure of a query to the service, as classified by the retry
+# policy: a temporary error, a rate limit, a blocked account or a location
+# the service no longer considers current
+FAILURE = Enum(["TRANSIENT", "RATE_LIMITED", "BLOCKED", "STALE_LOCATION"])
+# recovery from a failed query: ask again after a delay, hand the query
+# over to another account, retire the account or set its location again
+RECOVERY = Enum(["RETRY", "ROTATE", "RETIRE", "RELOCATE"])
@@ -3,20 +3,37 @@
 from __future__ import absolute_import
 import sqlite3
 import os
+import threading
+from functools import wraps
 
 from libs import verbose
 import auditor_constants as const
 
+def _synchronized(method):
+    """Runs @method holding the lock of the database, so that a connection
+    can be shared by the threads of concurrent attacks
+    """
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
 class AuditorDB(object):
     """Database related functionality
     """
 
+    # maximum number of parameters bound to a single statement
+    MAX_PARAMS = 500
+
     def __init__(self, db_name="testing.db", logging=const.LOG.STANDARD):
         if os.path.isfile(db_name):
             self._db = db_name
         else:
             self._db = ''.join(os.getcwd() + "/" + os.path.basename(db_name))
 
+        self.lock = threading.RLock()
         self.setup()
 
         self.conn = None
@@ -36,7 +53,8 @@ class AuditorDB(object):
     def connect(self):
         """Connect to db
         """
-        self.conn = sqlite3.connect(self._db)
+        # statements are serialised by the lock instead
+        self.conn = sqlite3.connect(self._db, check_same_thread=False)
 
     def close_connection(self):
         """Close connection to the database
@@ -185,6 +203,7 @@ class AuditorDB(object):
     #
     #
 
+    @_synchronized
     def insert_test(self, name):
         """Insert a new service_test in the database.
         @service_name is the name of the service
@@ -195,6 +214,7 @@ class AuditorDB(object):
         cur.execute("INSERT INTO SERVICE_TESTS(NAME) VALUES (?)", [name])
         self.conn.commit()
 
+    @_synchronized
     def insert_service(self, service_name):
         """Insert a new service in the database.
         @service_name is the name of the service
@@ -210,6 +230,7 @@ class AuditorDB(object):
         except sqlite3.IntegrityError:
             print "[db] Record already exists.. ignoring"
 
+    @_synchronized
     def insert_user(self, username, service_id, lat=None, lon=None):
         """Insert user in the database.
         @service_id is the id of the service for that user
@@ -225,6 +246,18 @@ class AuditorDB(object):
         except sqlite3.IntegrityError:
             print "[db] Record already exists.. ignoring"
 
+    @_synchronized
+    def insert_users(self, usernames, service_id):
+        """Insert all @usernames of service @service_id that do not exist in
+        the database in a single transaction
+        """
+        cur = self.conn.cursor()
+        stmt = ("INSERT OR IGNORE INTO USERS (IS_ACTIVE, QUERIES, SERVICE, "
+                "USERNAME, LAT, LON) VALUES (0, 0, ?, ?, NULL, NULL)")
+        cur.executemany(stmt, [(service_id, u) for u in usernames])
+        self.conn.commit()
+
+    @_synchronized
     def insert_query(self, query_id, test_id, user_id, service_id, info):
         """Insert query in the database.
         @test_id: the id of the test that issued the query
@@ -254,6 +287,7 @@ class AuditorDB(object):
     #
     #
 
+    @_synchronized
     def update_service(self, service_id, speed_limit, abs_limit, qps_limit,
                        dudp_accuracy, rudp_accuracy, verifies_loc):
         """Update limits of service
@@ -273,6 +307,7 @@ class AuditorDB(object):
                            service_id))
         self.conn.commit()
 
+    @_synchronized
     def update_user(self, user_id, is_active, queries, lat=None, lon=None,
                     add_queries=False):
         """Update a user record in the database setting them active/inactive
@@ -300,6 +335,22 @@ class AuditorDB(object):
         cur.execute(stmt, (is_active, t_queries, lat, lon, user_id))
         self.conn.commit()
 
+    @_synchronized
+    def update_users(self, records):
+        """Update many user records in a single transaction
+
+        Args:
+            records: list of (is_active, queries, lat, lon, updated_at,
+                     user_id) tuples, @updated_at being the time of the last
+                     move in seconds since the epoch
+        """
+        cur = self.conn.cursor()
+        stmt = ("UPDATE USERS SET IS_ACTIVE=?, QUERIES=?, LAT=?, "
+                "LON=?, UPDATED_AT=datetime(?, 'unixepoch') WHERE ID=?")
+        cur.executemany(stmt, records)
+        self.conn.commit()
+
+    @_synchronized
     def log_query_fail(self, query_id):
         """Update a query in the database.
         @service_id: the id of the service to which the query is issued
@@ -317,6 +368,7 @@ class AuditorDB(object):
     #
     #
 
+    @_synchronized
     def get_ordered_users(self, user_no=None):
         """Order users by queries and order @user_no users with the least
         queries in descending order. If user_no is None, return All users
@@ -333,6 +385,7 @@ class AuditorDB(object):
         else:
             raise SystemExit("No users found!")
 
+    @_synchronized
     def get_service_id(self, name):
         """Get the id of a service with name @name
         """
@@ -348,6 +401,7 @@ class AuditorDB(object):
                 raise SystemExit("Could not insert user")
         return _row[0]
 
+    @_synchronized
     def get_test_id(self, name):
         """Get the id of a test with name @name
         """
@@ -361,6 +415,7 @@ class AuditorDB(object):
             raise SystemExit("No such test")
         return _row[0]
 
+    @_synchronized
     def fetch_user_info(self, username, service_id):
         """Gets user queries, location and update_timestamp for that location
         """
@@ -378,6 +433,27 @@ class AuditorDB(object):
         else:
             return None
 
+    @_synchronized
+    def fetch_users_info(self, usernames, service_id):
+        """Gets the info of fetch_user_info for all @usernames of service
+        @service_id with as few statements as possible
+
+        Returns:
+            a dict from username to (id, queries, [lat, lon], timestamp) for
+            the users found
+        """
+        cur = self.conn.cursor()
+        infos = {}
+        for start in range(0, len(usernames), self.MAX_PARAMS):
+            chunk = usernames[start:start + self.MAX_PARAMS]
+            stmt = ("SELECT USERNAME, ID, QUERIES, LAT, LON, UPDATED_AT FROM "
+                    "USERS WHERE SERVICE=? AND USERNAME IN (" +
+                    ",".join("?" * len(chunk)) + ")")
+            cur.execute(stmt, [service_id] + list(chunk))
+            for _row in cur.fetchall():
+                infos[_row[0]] = (_row[1], _row[2], [_row[3], _row[4]], _row[5])
+        return infos
+
     #
     #
     #
@@ -386,6 +462,7 @@ class AuditorDB(object):
     #
     #
 
+    @_synchronized
     def log_exception(self, log_data, username=None):
         """Update the database records in case of failure
 
@@ -399,6 +476,7 @@ class AuditorDB(object):
                     username)
         self.conn.commit()
 
+    @_synchronized
     def log_unknown_exception(self, error_msg, user_id):
         """Catch an unkown exception raised by the caller app
         """
@@ -407,6 +485,7 @@ class AuditorDB(object):
         cur.execute(stmt, (error_msg, user_id))
         self.conn.commit()
 
+    @_synchronized
     def exception_recovery(self, query_id):
         """Get last exception that was inserted and update the respective query
         to insert any log data in the query log
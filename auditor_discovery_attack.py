@@ -2,18 +2,24 @@
 """
 from __future__ import absolute_import
 import os
-import json
 import math
-import random
+from threading import Thread
 from time import sleep, time
 
+import numpy as np
+
 from libs.kmlparser import KMLParser
-from libs import cells, vector, earth
+from libs import cells, cover, vector, earth, raster, posterior
+from libs import projections
+from libs.cache import GeometryCache
 from libs import verbose as vb
 from shapely.geometry import Point
 
 import auditor_constants as const
 import auditor_proximity_oracle as apo
+from auditor_artifacts import ArtifactWriter, StepLog
+from auditor_scheduler import AttackerScheduler, QueryBudget
+from auditor_retry import RetryPolicy, classify
 
 class DiscoveryAttack(object):
     """Generic Attack class
@@ -25,42 +31,41 @@ class DiscoveryAttack(object):
     # directory to hold kml files with
     # all polygonal areas used in the attack
     KML_DIR = "files/kml/"
-    # directory to hold json object with
+    # directory to hold the json lines with
     # all the attack info per query
     JSON_DIR = "files/json/"
 
     # stop binary search is area is smaller than BINARY_STOP_AREA
     BINARY_STOP_AREA = 100
 
+    # the posterior binary stops once no query is expected to gain
+    # at least MIN_GAIN bits of information
+    MIN_GAIN = 0.05
+
+    # trilateration keeps taking rings while the best next ring is expected
+    # to gain at least MIN_RING_GAIN bits, for at most MAX_RINGS rings
+    MIN_RING_GAIN = 0.25
+    MAX_RINGS = 8
+
+    # duration in sec of a place and query cycle, against which the wait
+    # for the speed limit before moving to a candidate position is weighed
+    QUERY_SECONDS = 10.0
+
+    # active regions are simplified with this tolerance (in m) between steps
+    # so that their number of vertices stays bounded
+    SIMPLIFY_TOLERANCE = math.sqrt(BINARY_STOP_AREA) / 10
+
     # at every step of the binary search, we expect to
     # reduce the active search region at least 10%
     # otherwise something is not right
     MIN_REDUCTION = 0.01
 
-    # json object to hold all
-    # stages of the attack
-    json_out = {
-        # queries run during coverage
-        # stage of the attack
-        "coverage" : [],
-        # queries run during DUDP
-        # stage of the attack
-        "DUDP" : [],
-        # queries run during RUDP
-        # stage of the attack
-        "RUDP" : [],
-        # location of victim as reported
-        # by the attack
-        "est_location" : [],
-        # real location of victim based on
-        # the coordinates passed to the
-        # service on the last update
-        "real_location" : [],
-    }
-
     def __init__(self, auditor, attackers, attacker, victim, proj, oracle,
                  test_id, service, test_name, verbose, kml=None, query_lim=None,
-                 speed_limit=None):
+                 speed_limit=None, local_proj=False,
+                 cut_method=const.CUT.RASTER, raster_resolution=None,
+                 artifact_level=const.ARTIFACT.ALL,
+                 artifact_format=const.ARTIFACT_FORMAT.KML):
         """Initializes a Discovery attack
 
         Args:
@@ -69,14 +74,29 @@ class DiscoveryAttack(object):
             oracle: an instance of the ProximityOracle class, either DUDP
                     RUDP or a custom oracle defined by the inherited service
             kml: a path of a kml file with the search area for the victim
+            local_proj: if True, @proj is replaced by a projection centred
+                        at the search area that preserves distances
+            cut_method: engine used to find the cuts of the binary phase,
+                        one of const.CUT
+            raster_resolution: if not None, the binary phase keeps the
+                               active region as a raster mask with cells of
+                               this size in m instead of a polygon
+            artifact_level: detail of the geometries written for each step,
+                            one of const.ARTIFACT
+            artifact_format: format of the step geometries, one of
+                             const.ARTIFACT_FORMAT
         """
         # FIXME add sleep times depending on query rate
         self.kmlparser = KMLParser(proj)
+        self.cache = GeometryCache(proj)
         # pass Auditor class
         self.auditor = auditor
-        self.attackers_backup = list(attackers)
-        self.attackers = attackers
-        self.restart_times = 0
+        # every placement goes to the account that can reach it soonest,
+        # keeping each account within the query limits of the service
+        budget = QueryBudget(auditor.absq_limit, auditor.qps_limit)
+        self.scheduler = AttackerScheduler([attacker] + list(attackers),
+                                           speed_limit,
+                                           budget)
         self.attacker = attacker
         self.victim = victim
         self.proj = proj
@@ -91,8 +111,34 @@ class DiscoveryAttack(object):
         #
         # grid size for calculations: can be modified by user in xxx_attack call
         self.grid_size = 20
+        # engine used to find the cuts of the binary phase
+        self.cut_method = cut_method
+        # if not None, the binary phase keeps the active region as a raster
+        # mask with cells of raster_resolution m instead of a polygon
+        self.raster_resolution = raster_resolution
+        # if not None, oracle answers are assumed to be wrong with
+        # probability oracle_error and the binary phase keeps a posterior
+        # probability grid instead of a single active region
+        self.oracle_error = None
         # query no in the current attack
         self.attack_queries = 0
+        # whether circles and rings are corrected for the distance error
+        # of the projection, and the relative bound of that error when a
+        # local projection is used instead
+        self.correct_proj_error = True
+        self.proj_error_bound = None
+        # projection errors over the search area, sampled once
+        self.error_field = None
+        # detail and format of the geometries written for each step
+        self.artifact_level = artifact_level
+        self.artifact_format = artifact_format
+        # background writer of the step geometries, created on first use
+        self.artifacts = None
+        # recovery from failed queries
+        self.retry = RetryPolicy()
+        # if at least 3, trilateration starts with this many attackers
+        # placed around the search area and queried concurrently
+        self.ring_attackers = 1
 
         self.test_name = test_name
         self.service_name = service
@@ -108,59 +154,207 @@ class DiscoveryAttack(object):
         if not os.path.exists(self.json_dir):
             os.makedirs(self.json_dir)
 
+        # one json line for every step of the attack, stages are
+        # "coverage", "DUDP", "RUDP", "est_location" and "real_location"
+        self.steps = StepLog(self.json_dir + self.service_name + "_UDP_" +
+                             str(self.test_id) + ".jsonl")
+
         #
         # Set up victim and seaerth area
         #
         if kml is None:
             self.kml = ''.join(os.getcwd() + "/" + self.NY_METROPOLITAN)
-            self.search_area = self.kmlparser.poly_from_kml(self.kml)
+        elif os.path.isfile(kml):
+            self.kml = kml
         else:
-            if os.path.isfile(kml):
-                self.kml = kml
-                self.search_area = self.kmlparser.poly_from_kml(kml)
-            else:
-                raise SystemExit("No such kml file")
+            raise SystemExit("No such kml file")
+
+        # the projected search area and its grids are cached on disk
+        self.area_key = self.cache.area_key(self.kml)
+        self.search_area = self.cache.search_area(self.kml,
+                                                  self.kmlparser.poly_from_kml,
+                                                  self.area_key)
+        if local_proj:
+            self._use_local_projection()
+        else:
+            self.error_field = projections.ErrorField(self.proj,
+                                                      self.search_area.bounds)
+            vb.vb_print(self.verbose,
+                        "Projection error field accuracy: " +
+                        str(self.error_field.accuracy * 100) + "%",
+                        "UDP",
+                        True)
+
+        self._place_victim(victim)
+
+    def _use_local_projection(self):
+        """Switches to an azimuthal equidistant projection centred at the
+        search area, reprojecting the area, and turns off the projection
+        error corrections
+        """
+        centroid = self.search_area.centroid
+        (lon, lat) = self.proj(centroid.x, centroid.y, inverse=True)
+        self.proj = projections.local_aeqd(lat, lon)
+        self.kmlparser = KMLParser(self.proj)
+        self.cache = GeometryCache(self.proj)
+        self.area_key = self.cache.area_key(self.kml)
+        self.search_area = self.cache.search_area(self.kml,
+                                                  self.kmlparser.poly_from_kml,
+                                                  self.area_key)
+
+        self.proj_error_bound = projections.distance_error_bound(
+            self.proj,
+            self.search_area.bounds)
+        self.correct_proj_error = False
+        vb.vb_print(self.verbose,
+                    "Local projection centred at " + str([lat, lon]) +
+                    ", max distance error: " +
+                    str(self.proj_error_bound * 100) + "%",
+                    "UDP",
+                    True)
 
+    def _place_victim(self, victim):
+        """Places @victim at a random location in the search area
+        """
         # get random victim location in projected coordinates
         (vict_x, vict_y) = self.kmlparser.random_from_polygon(self.search_area,
                                                               1)[0]
-        (vict_lon, vict_lat) = proj(vict_x, vict_y, inverse=True)
+        (vict_lon, vict_lat) = self.proj(vict_x, vict_y, inverse=True)
         vb.vb_print(self.verbose,
                     "Placing victim at " + str([vict_lat, vict_lon]))
         # place victim
-        (success, queries) = auditor.auditor_handled_place_at_coords(victim,
-                                                                     vict_lat,
-                                                                     vict_lon,
-                                                                     test_id)
+        (success, queries) = self.auditor.auditor_handled_place_at_coords(
+            victim,
+            vict_lat,
+            vict_lon,
+            self.test_id)
         self.attack_queries += queries
         if not success:
             raise SystemExit("Could not place victim")
 
-    def _update_attacker(self):
-        """Get a new attacker from the available users
+    @property
+    def restart_times(self):
+        """Times the pool of attackers has been exhausted and restored
         """
-        if len(self.attackers) == 0:
+        return self.scheduler.restarts
+
+    def _choose_attacker(self, lat=None, lon=None):
+        """Makes the account of the pool that can reach [@lat, @lon] soonest
+        the current attacker
+        """
+        restarts = self.scheduler.restarts
+        (self.attacker, wait) = self.scheduler.choose(lat, lon)
+        if self.scheduler.restarts != restarts:
             vb.vb_print(self.verbose,
                         " *** RUN OUT OF ATTACKERS - RESTARTING  ***",
                         "UDP",
                         True)
-            self.attackers = self.attackers_backup
-            self.restart_times += 1
-
+        if wait > 0:
+            vb.vb_print(self.verbose,
+                        " *** next attacker can move in " +
+                        str(int(wait) + 1) + "s ***",
+                        "UDP",
+                        True)
+        # moves are delayed by the auditor, queries are delayed here
+        pause = self.scheduler.budget.pause(self.attacker)
+        if pause > 0:
+            sleep(pause)
+
+    def _spare_attacker(self):
+        """Hands the next query over to another account, placed at the
+        location of the current attacker, if the current attacker is about
+        to reach a query limit
+        """
+        current = self.attacker
+        if not self.scheduler.spent(current):
+            return
+        if current.loc is None or current.loc[0] is None:
+            self._choose_attacker()
+            return
+        (user, _) = self.scheduler.choose(current.loc[0], current.loc[1])
+        if user is current:
+            # no other account is ready sooner, wait for the rate limit
+            sleep(self.scheduler.budget.pause(current))
+            return
+        vb.vb_print(self.verbose,
+                    " *** rotating attacker before query limit ***",
+                    "UDP",
+                    True)
+        self._place_at_coords(None, current.loc[0], current.loc[1],
+                              self.test_id)
 
+    def _update_attacker(self):
+        """Replaces the current attacker after a failure by the account that
+        can reach their location soonest
+        """
         vb.vb_print(self.verbose, " *** updating attacker ***", "UDP", True)
-        self.attacker = self.attackers.pop()
-        # sleep for some period
-        sleep(10)
+        failed = self.attacker
+        self.scheduler.retire(failed)
+        if failed.loc is None or failed.loc[0] is None:
+            self._choose_attacker()
+        else:
+            # take over the position of the failed attacker so that the
+            # pending query is asked from the same location
+            self._place_at_coords(None, failed.loc[0], failed.loc[1],
+                                  self.test_id)
 
     def _log_kml(self, msg, polygon):
-        """Outputs a kml in @KML_DIR
+        """Queues @polygon to be written to the artifacts of the attack in
+        @KML_DIR
+
+        Returns:
+            the id of the step geometry in the artifacts, or None if steps
+            of kind @msg are not written at the current artifact_level
+        """
+        if self.artifacts is None:
+            output = self.kml_dir + self.service_name + "_" + self.test_name
+            output += str(self.test_id)
+            self.artifacts = ArtifactWriter(output,
+                                            self.kmlparser,
+                                            self.artifact_level,
+                                            self.artifact_format)
+        if not self.artifacts.wants(msg):
+            return None
+        if isinstance(polygon, posterior.PosteriorGrid):
+            # the grid keeps changing, take a snapshot
+            polygon = polygon.to_polygon()
+        name = "q_" + str(self.restart_times) + "_"
+        name += str(self.attack_queries) + "_" + msg
+        return self.artifacts.log(name, msg, polygon)
+
+    def _close_artifacts(self):
+        """Waits for the step geometries to be written out and closes the
+        step log
         """
-        output_kml = self.kml_dir + self.service_name + "_" + self.test_name
-        output_kml += str(self.test_id) + "_q_" + str(self.restart_times) + "_"
-        output_kml +=  str(self.attack_queries) + "_" + msg + ".kml"
-        kml = self.kmlparser.kml_from_poly(polygon, output_kml)
-        return kml
+        try:
+            if self.artifacts is not None:
+                failures = self.artifacts.close()
+                self.artifacts = None
+                if failures > 0:
+                    self.steps.append("artifact_failures",
+                                      {"geometries": failures})
+                    vb.vb_print(self.verbose,
+                                str(failures) + " step geometries could " +
+                                "not be written",
+                                "UDP",
+                                True)
+        finally:
+            self.steps.append("retry_metrics", self.retry.metrics)
+            self.steps.close()
+
+    def _bound_region(self, region):
+        """Simplifies an active region to keep its complexity bounded
+        between steps and reports its number of vertices
+        """
+        if isinstance(region, raster.RasterRegion):
+            return region
+        region = cells.simplify_region(region, self.SIMPLIFY_TOLERANCE)
+        vb.vb_print(self.verbose,
+                    "Active region vertices: " +
+                    str(cells.vertex_count(region)),
+                    "UDP",
+                    True)
+        return region
 
     def __get_candidate_dist(self, distance, rounding_class):
         """Depending on the rounding class type, inverse rounding
@@ -192,30 +386,12 @@ class DiscoveryAttack(object):
             else:
                 return [0, distance +  rounding]
 
-    def __get_ring(self, minR):
-        """Asks the proximity oracle and creates a ring respectively
-        If we are in the base rounding class, we switch to binary
+    def __get_distance_range(self, dist):
+        """Returns the candidate values [min, max] in km for the real
+        distance given the distance @dist returned by the oracle, or None
+        if @dist is not in any rounding class
         """
-
-        # we expect to get an answer from the oracle
-        # loop if there is an error and change attacker
-        dist = None
-        attempts = 0
-        while dist is None:
-            # get distance and queries from the oracle
-            (dist, queries) = self.oracle.in_proximity(self.attacker,
-                                                       self.victim,
-                                                       self.test_id)
-            sleep(2)
-            # increase total queries
-            self.attack_queries += queries
-
-            # increase queries
-            if dist is None and attempts > 5:
-                self._update_attacker()
-            attempts += 1
-
-        # at this poing we god a distance from the proximity oracle
+        real_dist = None
         # see in which rounding class this oracle belongs to
         for round_class in sorted([cl[0] for cl in self.oracle.round_cl]):
             # get the ranges for which this rounding class is active
@@ -232,7 +408,358 @@ class DiscoveryAttack(object):
                         # see what the real distance might be (in km)
                         real_dist = self.__get_candidate_dist(dist, cl)
                         break
+        return real_dist
+
+    def _intersect_ring(self, inter, ring):
+        """Returns the intersection of the active region @inter with @ring,
+        logging both
+        """
+        #XXX no need to check for multipolygon in case of DUDP
+        # as we are working inside a polygonal area
+        inter_new = None
+        if inter.geom_type == "MultiPolygon":
+            for p in inter:
+                cut_inter = p.intersection(ring)
+                if inter_new is None:
+                    inter_new = cut_inter
+                else:
+                    inter_new = inter_new.union(cut_inter)
+        else:
+            inter_new = inter.intersection(ring)
+
+        # update the intersection
+        inter = ring if inter_new.is_empty else inter_new
+        inter = self._bound_region(inter)
+
+        # log kml files
+        self.steps.append("RUDP", {"query": self.attack_queries,
+                                   "ring": self._log_kml("ring", ring),
+                                   "active_area": self._log_kml("inter",
+                                                                inter),
+                                  })
+        return inter
+
+    def _move_to_next_ring(self, inter):
+        """Places the attacker where the next ring is expected to shrink the
+        active region @inter the most
+
+        Returns:
+            False if trilateration should stop instead, i.e. the region is
+            small enough for binary or no ring is expected to pay off.
+            Trilateration goes on regardless of the expected gain while the
+            region is split into several parts, which binary cannot tell
+            apart, or too small for the gain to be estimated
+        """
+        if inter.area <= self.BINARY_STOP_AREA:
+            return False
+        plan = self._plan_ring(inter)
+        if plan is None:
+            return False
+        (new_loc, gain) = plan
+        vb.vb_print(self.verbose,
+                    "Next ring expected to gain " + str(gain) + " bits",
+                    "UDP",
+                    True)
+        ambiguous = (not isinstance(inter, raster.RasterRegion) and
+                     len(raster.polygon_parts(inter)) > 1)
+        if (gain < self.MIN_RING_GAIN and not ambiguous and
+                len(raster.region_points(inter)) >= 2):
+            return False
+
+        self._place_at_coords(self.attacker,
+                              new_loc[0],
+                              new_loc[1],
+                              self.test_id)
+        return True
+
+    def _concurrent_rings(self, inter, count):
+        """Places @count attackers evenly around the active region @inter
+        and asks the oracle for the victim distance from all of them at
+        once, so the placement sleeps and speed limit waits are paid once
+
+        Each position goes to a different account of the pool, the one that
+        can reach it soonest, and no more attackers are placed than the
+        query limit allows. Attackers whose placement or query fails are
+        left out, and as in _place_at_coords a rate limited one is held off
+        while one that failed to be placed for any other reason is retired.
 
+        Returns:
+            the rings of the attackers that got an answer
+        """
+        # each attacker is placed and asks the oracle at least once
+        count = int(min(count, (self.query_limit - self.attack_queries) / 2))
+        if count < 3:
+            vb.vb_print(self.verbose,
+                        "Not enough queries left for concurrent rings",
+                        "UDP",
+                        True)
+            return []
+
+        points = raster.region_points(inter)
+        centre = points.mean(axis=0)
+        reach = max(math.sqrt(((points - centre) ** 2).sum(axis=1).max()),
+                    1.0)
+        angles = 2 * math.pi * np.arange(count) / float(count)
+        lonlat = projections.unproject(
+            self.proj,
+            centre + reach * np.column_stack((np.cos(angles),
+                                              np.sin(angles))))
+
+        attackers = []
+        for (lon, lat) in lonlat:
+            (user, _) = self.scheduler.choose(lat, lon, exclude=attackers)
+            if user is None:
+                break
+            attackers.append(user)
+        if len(attackers) < 3:
+            vb.vb_print(self.verbose,
+                        "Not enough attackers for concurrent rings",
+                        "UDP",
+                        True)
+            return []
+
+        vb.vb_print(self.verbose,
+                    "Placing " + str(len(attackers)) + " attackers at once",
+                    "UDP",
+                    True)
+        results = [None] * len(attackers)
+
+        def place_and_ask(i):
+            try:
+                # the failures are tracked per thread
+                self.auditor.last_failure = None
+                (lon, lat) = lonlat[i]
+                (placed, queries) = \
+                    self.auditor.auditor_handled_place_at_coords(
+                        attackers[i],
+                        float(lat),
+                        float(lon),
+                        self.test_id)
+                dist = None
+                if placed:
+                    # sleep until location is updated
+                    sleep(2)
+                    (dist, asked) = self.oracle.in_proximity(attackers[i],
+                                                             self.victim,
+                                                             self.test_id)
+                    queries += asked
+                results[i] = (placed, dist, queries,
+                              self.auditor.last_failure)
+            except Exception as exception:
+                results[i] = exception
+
+        threads = [Thread(target=place_and_ask, args=(i,))
+                   for i in range(len(attackers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # charge the queries of every attacker before raising any error
+        error = None
+        for (attacker, result) in zip(attackers, results):
+            if isinstance(result, Exception):
+                error = result if error is None else error
+                continue
+            self.attack_queries += result[2]
+            self.scheduler.charge(attacker, result[2])
+        if error is not None:
+            raise error
+
+        rings = []
+        for (attacker, (placed, dist, _, failure)) in zip(attackers, results):
+            if not placed or dist is None:
+                if classify(failure) == const.FAILURE.RATE_LIMITED:
+                    self.scheduler.budget.hold(attacker, self.retry.rate_base)
+                elif not placed:
+                    self.scheduler.retire(attacker)
+                continue
+            real_dist = self.__get_distance_range(dist)
+            if real_dist is None:
+                continue
+            # carry on from one of the attackers that got an answer
+            self.attacker = attacker
+            rings.append(cells.ring(attacker.loc[0],
+                                    attacker.loc[1],
+                                    float(real_dist[0]) * 1000,
+                                    float(real_dist[1]) * 1000,
+                                    self.proj,
+                                    correct=self.correct_proj_error,
+                                    error_field=self.error_field))
+        return rings
+
+    def _ring_range(self, dists):
+        """Vectorised __get_candidate_dist: the ring [lo, hi] (in m) that
+        the answer of the oracle yields for each of the true distances
+        @dists (in m), NaN where no rounding class applies
+        """
+        dists = np.asarray(dists, dtype=float) / 1000
+        lo = np.empty(len(dists))
+        hi = np.empty(len(dists))
+        lo.fill(np.nan)
+        hi.fill(np.nan)
+        for [[min_r, max_r], rounding, family] in self.oracle.round_cl:
+            mask = (dists >= min_r) & (dists <= max_r) & np.isnan(lo)
+            if family == const.ROUNDING.UP:
+                value = np.ceil(dists[mask] / rounding) * rounding
+                (lo[mask], hi[mask]) = (value - rounding, value)
+            elif family == const.ROUNDING.DOWN:
+                value = np.floor(dists[mask] / rounding) * rounding
+                (lo[mask], hi[mask]) = (value, value + rounding)
+            elif family == const.ROUNDING.BOTH:
+                value = np.round(dists[mask] / rounding) * rounding
+                (lo[mask], hi[mask]) = (value - rounding, value + rounding)
+        return np.maximum(lo, 0) * 1000, hi * 1000
+
+    def _plan_ring(self, inter, directions=16, offsets=9):
+        """Picks the position of the next trilateration query
+
+        Candidate positions lie on rays from the centre of the active
+        region @inter, up to twice its reach. Each is scored by the
+        information of its ring, i.e. -log2 of the expected fraction of the
+        region left after it, which accounts for the rounding class the
+        victim distance falls in from there. Positions from which some
+        victim locations get no answer are avoided, and the score is
+        divided by the cost of getting there: one place and query cycle
+        plus the wait of the account that can reach it soonest.
+
+        Returns:
+            ([lat, lon], gain) of the best position and its expected gain
+            in bits, or None if no position can be scored
+        """
+        points = raster.region_points(inter)
+        centre = points.mean(axis=0)
+        reach = max(math.sqrt(((points - centre) ** 2).sum(axis=1).max()),
+                    1.0)
+        angles = 2 * math.pi * np.arange(directions) / float(directions)
+        steps = np.linspace(0, 2 * reach, offsets)
+        centres = (centre[None, None, :] +
+                   np.column_stack((np.cos(angles),
+                                    np.sin(angles)))[:, None, :] *
+                   steps[None, :, None]).reshape(-1, 2)
+
+        (remaining, unanswered) = raster.ring_remaining(points,
+                                                        centres,
+                                                        self._ring_range)
+        answered = unanswered == 0
+        if not answered.any():
+            return None
+        gain = -np.log2(np.maximum(remaining, 1e-12))
+
+        lonlat = projections.unproject(self.proj, centres)
+        cost = np.empty(len(centres))
+        for (i, (lon, lat)) in enumerate(lonlat):
+            wait = min(self.scheduler.wait(u, lat, lon)
+                       for u in self.scheduler.active or self.scheduler.pool)
+            cost[i] = 1 + wait / self.QUERY_SECONDS
+
+        value = np.where(answered, gain / cost, -1)
+        best = int(np.argmax(value))
+        return ([float(lonlat[best][1]), float(lonlat[best][0])],
+                float(gain[best]))
+
+    def _ask_oracle(self, victim=None):
+        """Asks the proximity oracle about @victim (by default the victim
+        of the attack) until we get an answer, changing attacker if the
+        oracle keeps failing
+
+        Returns:
+            the answer of the oracle
+        """
+        if victim is None:
+            victim = self.victim
+        # ask the oracle if the victim is in proximity
+        return self._query(lambda: self.oracle.in_proximity(self.attacker,
+                                                            victim,
+                                                            self.test_id),
+                           lambda answer: answer is None)
+
+    def _query(self, ask, failed):
+        """Repeats the oracle query @ask from the current attacker until
+        @failed is False for its answer, recovering from each failure as
+        decided by the retry policy
+
+        Args:
+            ask: function asking the oracle and returning (answer, queries)
+            failed: function telling whether an answer is a failure
+
+        Returns:
+            the answer of the oracle
+        """
+        attempt = 0
+        while True:
+            self._spare_attacker()
+            self.auditor.last_failure = None
+            (answer, queries) = ask()
+            # increase queries
+            self.attack_queries += queries
+            self.scheduler.charge(self.attacker, queries)
+            if not failed(answer):
+                self.retry.succeeded()
+                return answer
+
+            attempt += 1
+            (kind, action, delay) = self.retry.recover(
+                self.auditor.last_failure,
+                attempt)
+            vb.vb_print(self.verbose,
+                        " *** " + kind + " failure: " + action + " ***",
+                        "UDP",
+                        True)
+            self.steps.append("retry", {"query": self.attack_queries,
+                                        "attempt": attempt,
+                                        "failure": kind,
+                                        "recovery": action,
+                                        "delay": delay})
+            if action == const.RECOVERY.RETRY:
+                sleep(delay)
+                continue
+
+            if action == const.RECOVERY.ROTATE:
+                # the next _spare_attacker hands the query over
+                self.scheduler.budget.hold(self.attacker, delay)
+            elif action == const.RECOVERY.RETIRE:
+                self._update_attacker()
+            elif action == const.RECOVERY.RELOCATE:
+                self._relocate_attacker()
+            attempt = 0
+
+    def _relocate_attacker(self):
+        """Sets the location of the current attacker again, for services
+        that stopped considering it current
+        """
+        (lat, lon) = self.attacker.loc
+        if lat is None or lon is None:
+            return
+        (success, queries) = self.auditor.auditor_handled_place_at_coords(
+            self.attacker,
+            lat,
+            lon,
+            self.test_id)
+        self.attack_queries += queries
+        self.scheduler.charge(self.attacker, queries)
+        if not success:
+            self._update_attacker()
+
+    def __get_ring(self, minR):
+        """Asks the proximity oracle and creates a ring respectively
+        If we are in the base rounding class, we switch to binary
+        """
+
+        def ask():
+            # get distance and queries from the oracle
+            rspn = self.oracle.in_proximity(self.attacker,
+                                            self.victim,
+                                            self.test_id)
+            sleep(2)
+            return rspn
+
+        # we expect to get an answer from the oracle
+        # loop if there is an error and recover as the retry policy says
+        dist = self._query(ask, lambda answer: answer is None)
+
+        # at this poing we god a distance from the proximity oracle
+        real_dist = self.__get_distance_range(dist)
         if real_dist is None:
             return None
 
@@ -249,22 +776,29 @@ class DiscoveryAttack(object):
                           attacker_location[1],
                           float(real_dist[0]) * 1000,
                           float(real_dist[1]) * 1000,
-                          self.proj)
+                          self.proj,
+                          correct=self.correct_proj_error,
+                          error_field=self.error_field)
 
         # return minimum distance and ring
         return real_dist, ring
 
 
-    def _place_at_coords(self, attacker, lat, lon, test_id):
-        """Attempt to update attacker location until we succeed
+    def _place_at_coords(self, _attacker, lat, lon, test_id):
+        """Attempt to place an attacker at [@lat, @lon] until we succeed
+
+        The attacker placed is the account of the pool that can reach the
+        location soonest, which becomes the current attacker
         """
         while True:
+            self._choose_attacker(lat, lon)
             vb.vb_print(self.verbose,
                         "Placing user at " + str(lat) + ", " + str(lon),
                         "UDP",
                         True)
-            query_id = int(time())
-            res = self.auditor.auditor_handled_place_at_coords(attacker,
+            query_id = self.auditor.next_query_id()
+            self.auditor.last_failure = None
+            res = self.auditor.auditor_handled_place_at_coords(self.attacker,
                                                                lat,
                                                                lon,
                                                                test_id,
@@ -273,9 +807,21 @@ class DiscoveryAttack(object):
             sleep(2)
             # add queries regardless of whether we failed
             self.attack_queries += res[1]
+            self.scheduler.charge(self.attacker, res[1])
             if res[0] is False:
-                # if for any reason update failed, change attacker
-                self._update_attacker()
+                # if the update failed, hold off a rate limited attacker
+                # and retire it for any other reason
+                vb.vb_print(self.verbose,
+                            " *** updating attacker ***",
+                            "UDP",
+                            True)
+                kind = classify(self.auditor.last_failure)
+                self.auditor.last_failure = None
+                if kind == const.FAILURE.RATE_LIMITED:
+                    self.scheduler.budget.hold(self.attacker,
+                                               self.retry.rate_base)
+                else:
+                    self.scheduler.retire(self.attacker)
             else:
                 return res
 
@@ -298,72 +844,88 @@ class DiscoveryAttack(object):
 
         #initially the intersection is the whole area
         inter = self.search_area
-        # place the attacker in the center
-        if self.attacker.loc is None or self.attacker.loc[0] is None:
-            starting_loc = cells.poly_centroid(inter, self.proj)
-            self._place_at_coords(self.attacker,
-                                  starting_loc[0],
-                                  starting_loc[1],
-                                  self.test_id)
 
         if self.oracle is None:
             self.oracle = apo.RoundingProximityOracle(self.auditor,
                                                       rounding_classes,
                                                       self.verbose)
 
-        # initially get a rough estimate with 3 queries from
-        # three locations at a distance of 120 degrees.
-        # Initiate intersection rings
         rings = []
-        for i in range(3):
+        if self.ring_attackers >= 3:
+            # first rough estimate from several attackers at once
+            for ring in self._concurrent_rings(inter, self.ring_attackers):
+                rings.append(ring)
+                inter = self._intersect_ring(inter, ring)
+
+        if len(rings) == 0:
+            # place the attacker in the center
+            if self.attacker.loc is None or self.attacker.loc[0] is None:
+                starting_loc = cells.poly_centroid(inter, self.proj)
+                self._place_at_coords(self.attacker,
+                                      starting_loc[0],
+                                      starting_loc[1],
+                                      self.test_id)
+        elif not self._move_to_next_ring(inter):
+            return inter
+
+        # take a ring from the current location, then keep moving to the
+        # position where the next ring is expected to shrink the
+        # intersection the most, until rings stop paying off
+        while (len(rings) < self.MAX_RINGS and
+               self.attack_queries < self.query_limit):
             # get a ring and check if we are switching to binary
             ring_response = self.__get_ring(MIN_R)
             if ring_response is None:
                 raise SystemExit("victim not found")
             else:
                 distance_range, ring = ring_response
-            self._log_kml("ring", ring)
             rings.append(ring)
+            inter = self._intersect_ring(inter, ring)
 
-            #XXX no need to check for multipolygon in case of DUDP
-            # as we are working inside a polygonal area
-            inter_new = None
-            if inter.geom_type == "MultiPolygon":
-                for p in inter:
-                    cut_inter = p.intersection(ring)
-                    if inter_new is None:
-                        inter_new = cut_inter
-                    else:
-                        inter_new = inter_new.union(cut_inter)
-            else:
-                inter_new = inter.intersection(ring)
-
-            # update the intersection
-            inter = ring if inter_new.is_empty else inter_new
-
-            # log kml files
-            self.json_out["RUDP"].append({"query": self.attack_queries,
-                                          "ring": self._log_kml("ring", ring),
-                                          "active_area": self._log_kml("inter",
-                                                                       inter),
-                                         })
-
-            # update attacker location
-            dist = float(distance_range[0] + distance_range[1]) / 2
-            # calculate new location for the next query
-            new_loc = earth.point_on_earth(self.attacker.loc[0],
-                                           self.attacker.loc[1],
-                                           dist,
-                                           i * 120)
-
-            self._place_at_coords(self.attacker,
-                                  new_loc[0],
-                                  new_loc[1],
-                                  self.test_id)
+            if not self._move_to_next_ring(inter):
+                break
 
         # switch to binary
         return inter
 
+    def _grid_points(self, R):
+        """Returns the hexagonal grid points of radius @R (in m) over the
+        search area, from the cache if they have been built before
+        """
+        return self.cache.grid(self.area_key,
+                               R,
+                               lambda: cells.hex_centres(self.search_area, R))
+
+    def _plan_coverage(self, disk_radii):
+        """Plans the disks used to cover the search area and creates the
+        disk oracle if needed
+
+        Returns:
+            (plan, radius_km) where @plan is the list of disks (x, y, R)
+            with R in m and @radius_km maps R to the radius in km
+        """
+        # plan a cover of the search area with disks of all the available
+        # radii before sending any queries. The planner works in m
+        radius_km = dict((float(r) * 1000, r) for r in disk_radii)
+        (plan, expected) = cover.plan_disk_cover(self.search_area,
+                                                 sorted(radius_km.keys()),
+                                                 self._grid_points)
+        if len(plan) == 0:
+            # Normally this should never trigger with the default kml
+            raise SystemExit("Can't create grid with the available radii")
+
+        vb.vb_print(self.verbose,
+                    "Coverage plan: " + str(len(plan)) + " disks, " +
+                    "expected queries: " + str(round(expected, 2)),
+                    "UDP",
+                    True)
+
+        if self.oracle is None:
+            self.oracle = apo.DiskProximityOracle(self.auditor,
+                                                  radius_km[plan[0][2]],
+                                                  self.verbose)
+        return plan, radius_km
+
     def _run_coverage(self, disk_radii):
         """Runs coverage algorithm on search_area
 
@@ -384,70 +946,21 @@ class DiscoveryAttack(object):
         """
         vb.vb_print(self.verbose, "Running Coverage", "UDP", True)
 
-        grid = cells.Cells(self.proj)
+        (plan, radius_km) = self._plan_coverage(disk_radii)
 
-        # get largest radius and try to create a grid
-        # with hexagons defined by r.
-        sorted_radii = sorted(disk_radii, reverse=True)
-        disk_radius = sorted_radii[0]
+        # coordinates of all the disks of the plan
+        lonlat = projections.unproject(self.proj,
+                                       [(x, y) for (x, y, R) in plan]).tolist()
 
-        # pdict is a dictionary with all the grid points.
-        # If no keys are found the radius r is too big to
-        # create a grid in the search area FIXME should we go for
-        # binary directly the moment we have one succesful query?
-        while len(grid.pdict.keys()) == 0:
-            vb.vb_print(self.verbose,
-                        "Attempting to create grid with R=" + str(disk_radius),
-                        "UDP",
-                        True)
-
-            # Attempt to construct grid with this radius
-            grid.construct_grid_in_polygon(self.search_area, disk_radius * 1000)
-            try:
-                # get the next smaller radius in case this
-                disk_radius = sorted_radii[next(x[0] for x in
-                                enumerate(sorted_radii) if x[1] < disk_radius)]
-            except StopIteration:
-                # Normally this should never trigger with the default kml
-                raise SystemExit("Can't create grid with the available radii")
-
-        vb.vb_print(self.verbose, "|--> Success!", "UDP", True)
-        idx = sorted_radii.index(disk_radius)
-
-        # Take previous r which is what the grid was made with
-        # since we have already decreased this once
-        disk_radius = sorted_radii[idx - 1]
-
-        if self.oracle is None:
-            self.oracle = apo.DiskProximityOracle(self.auditor,
-                                                  disk_radius,
-                                                  self.verbose)
-        else:
+        # FIXME we should update points based on the speed limits.
+        # Disks are queried in the order of the plan, which puts the
+        # disks most likely to contain the victim first.
+        for ((x, y, R), (lon, lat)) in zip(plan, lonlat):
+            disk_radius = radius_km[R]
             # set this radius in the oracle
             self.oracle.set_radius(disk_radius)
 
-        # create the oracle
-        grid_points = grid.pdict.keys()
-
-        # FIXME we should update points based on the speed limits
-        # currently let it randomly selects points.
-        #
-        # As a proper solution we should traverse the squares in a
-        # consistent manner (like following a path zig-zag from left
-        # to right then up then left etc). The problem is that if the
-        # current location of the attacker is in the middle we would
-        # have to do like a spiral which complicates stuff. So perhaps,
-        #                    |
-        #                    v
-        # Replace the for loop with a while loop and after every iteration,
-        # re-sort the remaining circles based on the distance from the
-        # current point. Ugly but works and hopefully we won't have many circles
-        random.shuffle(grid_points)
-        for point in grid_points:
             # FIXME update depending on query limiting rates
-            (lon, lat) = self.proj(float(point[0]),
-                                   float(point[1]),
-                                   inverse=True)
 
             # Place the user there respecting any speed constraints
             # Since the points are ordered based on the distance from
@@ -457,28 +970,16 @@ class DiscoveryAttack(object):
                                   lon,
                                   self.test_id)
             # ask oracle until we get a response
-            oracle_rspn = [None, None]
-            attempts = 0
-            while oracle_rspn[0] is None:
-                # ask the oracle if the victim is in proximity
-                oracle_rspn = self.oracle.in_proximity(self.attacker,
-                                            self.victim,
-                                            self.test_id)
-
-                # increase total queries of the attack
-                self.attack_queries += oracle_rspn[1]
-                if oracle_rspn[0] is None and attempts > 5:
-                    self._update_attacker()
-                attempts +=1
+            answer = self._ask_oracle()
 
-            circle = cells.circle(lat, lon, disk_radius * 1000, self.proj)
+            circle = Point(x, y).buffer(disk_radius * 1000)
             self._log_kml("coverage", circle)
-            self.json_out["coverage"].append({"query": self.attack_queries,
-                                              "disk": [lat,
-                                                       lon,
-                                                       disk_radius * 1000]})
-            if oracle_rspn[0] is not None:
-                if oracle_rspn[0] is True:
+            self.steps.append("coverage", {"query": self.attack_queries,
+                                           "disk": [lat,
+                                                    lon,
+                                                    disk_radius * 1000]})
+            if answer is not None:
+                if answer is True:
                     vb.vb_print(self.verbose,
                                 "Found at " + vector.to_str([lat, lon]) + " !",
                                 "DUDP",
@@ -499,26 +1000,44 @@ class DiscoveryAttack(object):
 
         vb.vb_print(self.verbose, "Running Binary", "UDP", True)
 
+        if self.raster_resolution is not None:
+            inter = raster.RasterRegion(inter, self.raster_resolution)
+
         last_inter_area = float('inf')
+        inter_id = self._log_kml("inter", inter)
         while (inter.area > self.BINARY_STOP_AREA and
                self.attack_queries < self.query_limit):
 
             vb.vb_print(self.verbose, "Estimating cut", "UDP", True)
             # find projected coordinates that cut inter in half
-            proj_coords = cells.cut(inter, self.proj, radius, grid_size)
+            if self.cut_method == const.CUT.RASTER:
+                proj_coords = cells.cut_raster(inter, self.proj, radius,
+                                               correct=self.correct_proj_error,
+                                               error_field=self.error_field)
+            elif isinstance(inter, raster.RasterRegion):
+                proj_coords = cells.cut(inter.to_polygon(), self.proj, radius,
+                                        grid_size, self.correct_proj_error,
+                                        self.error_field)
+            else:
+                proj_coords = cells.cut(inter, self.proj, radius, grid_size,
+                                        self.correct_proj_error,
+                                        self.error_field)
             circle = Point(proj_coords[0], proj_coords[1]).buffer(radius * 1000)
 
-            self.json_out["DUDP"].append({"query": self.attack_queries,
-                                          "disk": self._log_kml("disk",
-                                                                circle),
-                                          "active_area": self._log_kml("inter",
-                                                                       inter),
-                                         })
+            self.steps.append("DUDP", {"query": self.attack_queries,
+                                       "disk": self._log_kml("disk",
+                                                             circle),
+                                       "active_area": inter_id,
+                                      })
 
             # calculate the coordinates for the new cut query
             (query_lon, query_lat) = self.proj(proj_coords[0],
                                                proj_coords[1],
                                                inverse=True)
+            vb.vb_print(self.verbose,
+                        "Cutting from " + str([query_lat, query_lon]),
+                        "UDP",
+                        True)
 
             self._place_at_coords(self.attacker,
                                   query_lat,
@@ -528,20 +1047,18 @@ class DiscoveryAttack(object):
             if self.oracle is None:
                 raise SystemExit("oracle should not be None after coverage")
 
-            oracle_rspn = [None, None]
-            attempts = 0
-            while oracle_rspn[0] is None:
-                # ask the oracle if the victim is in proximity
-                oracle_rspn = self.oracle.in_proximity(self.attacker,
-                                                       self.victim,
-                                                       self.test_id)
-                # increase queries
-                self.attack_queries += oracle_rspn[1]
-                if oracle_rspn[0] is None and attempts > 5:
-                    self._update_attacker()
-                attempts += 1
-
-            if oracle_rspn[0] is True:
+            answer = self._ask_oracle()
+
+            if isinstance(inter, raster.RasterRegion):
+                if answer is True:
+                    inter_new = inter.intersect_circle(proj_coords[0],
+                                                       proj_coords[1],
+                                                       radius * 1000)
+                else:
+                    inter_new = inter.difference_circle(proj_coords[0],
+                                                        proj_coords[1],
+                                                        radius * 1000)
+            elif answer is True:
                 # if in proximity take the intersection
                 inter_new = inter.intersection(circle)
             else:
@@ -550,12 +1067,16 @@ class DiscoveryAttack(object):
 
             if inter_new.is_empty:
                 print "\n\n\t ***WARNING!! EMPTY INTERSECTION***\n\n"
-                inter = circle
+                if isinstance(inter, raster.RasterRegion):
+                    inter = raster.RasterRegion(circle, self.raster_resolution)
+                else:
+                    inter = circle
             else:
                 inter = inter_new
+            inter = self._bound_region(inter)
 
             # log kml
-            self._log_kml("inter", inter)
+            inter_id = self._log_kml("inter", inter)
 
             # if area is not reduced after intersection
             # break to avoid an infinite loop.
@@ -569,14 +1090,101 @@ class DiscoveryAttack(object):
             else:
                 last_inter_area = inter.area
 
+        return self._report_estimate(inter)
+
+    def _run_posterior(self, inter, radius):
+        """Runs binary on area tolerating wrong oracle answers
+
+        Instead of intersecting the active region with each answer, a
+        posterior probability grid is updated with each disk or ring
+        response, assuming every answer is wrong with probability
+        @oracle_error. Each query is placed where its answer is expected
+        to carry the most information, and the search stops once the
+        credible region is smaller than BINARY_STOP_AREA.
+
+        Args:
+            @inter: the projected polygon in which we are running
+                    the attack algorithm
+            @radius: the radius of the disk to perform the cuts
+        """
+        vb.vb_print(self.verbose, "Running Posterior Binary", "UDP", True)
+
+        R = radius * 1000
+        # the answer that gave us @inter may itself be wrong, so allow
+        # the victim to be up to a disk radius outside of it
+        grid = posterior.PosteriorGrid(inter.buffer(R),
+                                       self.oracle_error,
+                                       math.sqrt(self.BINARY_STOP_AREA) / 10)
+        grid.observe_region(inter)
+
+        if self.oracle is None:
+            raise SystemExit("oracle should not be None after coverage")
+
+        while (grid.area > self.BINARY_STOP_AREA and
+               self.attack_queries < self.query_limit):
+
+            vb.vb_print(self.verbose, "Estimating query", "UDP", True)
+            (proj_coords, gain) = grid.best_query(R)
+            if gain < self.MIN_GAIN:
+                vb.vb_print(self.verbose,
+                            "No informative query left ..stopping",
+                            "UDP",
+                            True)
+                break
+
+            circle = Point(proj_coords[0], proj_coords[1]).buffer(R)
+            self.steps.append("DUDP", {"query": self.attack_queries,
+                                       "disk": self._log_kml("disk",
+                                                             circle),
+                                       "active_area": self._log_kml("inter",
+                                                                    grid),
+                                      })
+
+            (query_lon, query_lat) = self.proj(proj_coords[0],
+                                               proj_coords[1],
+                                               inverse=True)
+            self._place_at_coords(self.attacker,
+                                  query_lat,
+                                  query_lon,
+                                  self.test_id)
+
+            answer = self._ask_oracle()
+            if isinstance(answer, bool):
+                grid.observe_disk(proj_coords[0], proj_coords[1], R, answer)
+            else:
+                # rounding oracles return a distance, i.e. a ring
+                real_dist = self.__get_distance_range(answer)
+                if real_dist is not None:
+                    grid.observe_ring(proj_coords[0],
+                                      proj_coords[1],
+                                      float(real_dist[0]) * 1000,
+                                      float(real_dist[1]) * 1000)
+
+            vb.vb_print(self.verbose,
+                        "Credible region: " + str(grid.area) + "m^2",
+                        "UDP",
+                        True)
+
+        return self._report_estimate(grid)
+
+    def _report_estimate(self, inter, victim=None):
+        """Estimates the location of @victim (by default the victim of the
+        attack) as the centroid of @inter, reports its distance from the
+        real location and logs both as steps of the attack
+
+        Returns:
+            the distance of the estimate from the real location in m
+        """
+        if victim is None:
+            victim = self.victim
         est_location = cells.poly_centroid(inter, self.proj)
         vb.vb_print(self.verbose,
                     "Estimated Location: " + str(est_location),
                     "UDP",
                     True)
 
-        real_est_distance = earth.distance_on_unit_sphere(self.victim.loc[0],
-                                                          self.victim.loc[1],
+        real_est_distance = earth.distance_on_unit_sphere(victim.loc[0],
+                                                          victim.loc[1],
                                                           est_location[0],
                                                           est_location[1])
         # convert to m
@@ -586,51 +1194,290 @@ class DiscoveryAttack(object):
                     "UDP",
                     True)
 
-        self.json_out["est_location"].append({"query": self.attack_queries,
-                                              "area" : inter.area,
-                                              "coords": [est_location[0],
-                                                         est_location[1]]})
-        self.json_out["real_location"].append({"query": -1,
-                                               "coords": [self.victim.loc[0],
-                                                          self.victim.loc[1]]})
-
-        output_json = ''.join(os.getcwd() + "/" + self.JSON_DIR)
-        output_json += self.service_name + "_UDP_"
-        with open(output_json + str(self.test_id) + ".json", "w") as outfile:
-            json.dump(self.json_out, outfile)
+        self.steps.append("est_location", {"query": self.attack_queries,
+                                           "area" : inter.area,
+                                           "coords": [est_location[0],
+                                                      est_location[1]]})
+        self.steps.append("real_location", {"query": -1,
+                                            "coords": [victim.loc[0],
+                                                       victim.loc[1]]})
 
         return real_est_distance
 
-    def dudp_attack(self, disk_radii, kml=None, grid_size=20):
+    def dudp_attack(self, disk_radii, kml=None, grid_size=20,
+                    oracle_error=None):
         """Runs a DUDP attack
 
         Args:
             disk_radii: the list of available radii for the disks used
                         by the service in km
+            oracle_error: probability that an oracle answer is wrong. If
+                          given, a posterior grid is used in the binary phase
         """
         # TODO add documentation
         self.grid_size = grid_size
+        self.oracle_error = oracle_error
 
-        # first limit search area into a single circle by running coverage
-        # store this circle as the current intersection (inter)
-        (inter, radius) = self._run_coverage(disk_radii)
+        try:
+            # first limit search area into a single circle by running
+            # coverage store this circle as the current intersection (inter)
+            (inter, radius) = self._run_coverage(disk_radii)
 
-        # now run binary
-        # store the area of the last intersection to make
-        # sure that after the cut the area is sufficiently reduced
-        return self._run_binary(inter, radius)
+            # now run binary
+            # store the area of the last intersection to make
+            # sure that after the cut the area is sufficiently reduced
+            if self.oracle_error is not None:
+                return self._run_posterior(inter, radius)
+            return self._run_binary(inter, radius)
+        finally:
+            self._close_artifacts()
 
 
-    def rudp_attack(self, rounding_classes, kml=None, grid_size=20):
+    def rudp_attack(self, rounding_classes, kml=None, grid_size=20,
+                    oracle_error=None, ring_attackers=1):
         """Runs an RUDP attack
 
         Args:
             rounding_classes: the rounding classes used by the service
+            oracle_error: probability that an oracle answer is wrong. If
+                          given, a posterior grid is used in the binary phase
+            ring_attackers: if at least 3, trilateration starts by placing
+                            this many attackers at once and querying them
+                            concurrently
         """
+        self.oracle_error = oracle_error
+        self.ring_attackers = ring_attackers
         # first limit search area by running trilateration
         # using the rounding classes. @inter variable now
         # contains an area that is smaller than the minimum
         # radius in the rounding class so we can launch binary
-        inter = self._run_trilateration(rounding_classes)
-        min_rounding = sorted([cl[1] for cl in rounding_classes])[0]
-        self._run_binary(inter, min_rounding)
+        try:
+            inter = self._run_trilateration(rounding_classes)
+            min_rounding = sorted([cl[1] for cl in rounding_classes])[0]
+            if self.oracle_error is not None:
+                return self._run_posterior(inter, min_rounding)
+            return self._run_binary(inter, min_rounding)
+        finally:
+            self._close_artifacts()
+
+
+class MultiDiscoveryAttack(DiscoveryAttack):
+    """DUDP attack against several victims at once
+
+    Every attacker placement is used to ask the oracle about all the
+    victims that have not been located yet, each victim keeping its own
+    active region. Cuts are chosen to reduce the combined uncertainty of
+    all the regions, so the cost of placing the attacker (update query,
+    sleeps and speed limit waits) is paid once for all victims.
+    """
+
+    # a cut counts towards the no progress stop of a victim only if the
+    # fraction of its region inside the circle is within
+    # [MULTI_SPLIT_BAND, 1 - MULTI_SPLIT_BAND]
+    MULTI_SPLIT_BAND = 0.25
+
+    # a victim is dropped anyway after this many cuts in a row that did not
+    # reduce its region significantly
+    MAX_STALLS = 10
+
+    def __init__(self, auditor, attackers, attacker, victims, proj, oracle,
+                 test_id, service, test_name, verbose, kml=None, query_lim=None,
+                 speed_limit=None, local_proj=False,
+                 artifact_level=const.ARTIFACT.ALL,
+                 artifact_format=const.ARTIFACT_FORMAT.KML):
+        """Initializes a Discovery attack against the list of @victims
+        """
+        DiscoveryAttack.__init__(self, auditor, attackers, attacker,
+                                 victims[0], proj, oracle, test_id, service,
+                                 test_name, verbose, kml, query_lim,
+                                 speed_limit, local_proj,
+                                 artifact_level=artifact_level,
+                                 artifact_format=artifact_format)
+        self.victims = list(victims)
+        for victim in self.victims[1:]:
+            self._place_victim(victim)
+
+    def _ask_all(self, victims):
+        """Asks the oracle about all @victims from the current location of
+        the attacker, with a single bulk query if the service supports it,
+        until there is an answer for each of them
+
+        Returns:
+            the list of answers in the order of @victims
+        """
+        answers = [None] * len(victims)
+
+        def ask():
+            # only ask again about the victims without an answer
+            pending = [i for (i, answer) in enumerate(answers) if answer is None]
+            (rspn, queries) = self.oracle.in_proximity_many(
+                self.attacker,
+                [victims[i] for i in pending],
+                self.test_id)
+            for (i, answer) in zip(pending, rspn):
+                answers[i] = answer
+            return (answers, queries)
+
+        return self._query(ask, lambda answer: None in answer)
+
+    def _run_coverage(self, disk_radii):
+        """Runs coverage for all victims until every victim is found or the
+        plan is exhausted
+
+        Returns:
+            a list with a (circle, radius) tuple for each victim, or None
+            for the victims that were not found
+        """
+        vb.vb_print(self.verbose, "Running Multi-victim Coverage", "UDP", True)
+
+        (plan, radius_km) = self._plan_coverage(disk_radii)
+
+        lonlat = projections.unproject(self.proj,
+                                       [(x, y) for (x, y, R) in plan]).tolist()
+
+        found = [None] * len(self.victims)
+        for ((x, y, R), (lon, lat)) in zip(plan, lonlat):
+            pending = [i for (i, disk) in enumerate(found) if disk is None]
+            if len(pending) == 0:
+                break
+
+            disk_radius = radius_km[R]
+            self.oracle.set_radius(disk_radius)
+            self._place_at_coords(self.attacker, lat, lon, self.test_id)
+
+            answers = self._ask_all([self.victims[i] for i in pending])
+
+            circle = Point(x, y).buffer(disk_radius * 1000)
+            self._log_kml("coverage", circle)
+            self.steps.append("coverage", {"query": self.attack_queries,
+                                           "disk": [lat,
+                                                    lon,
+                                                    disk_radius * 1000]})
+            for (i, answer) in zip(pending, answers):
+                if answer is True:
+                    vb.vb_print(self.verbose,
+                                "Victim " + str(i) + " found at " +
+                                vector.to_str([lat, lon]) + " !",
+                                "DUDP",
+                                True)
+                    found[i] = (circle, disk_radius)
+        return found
+
+    def _run_binary(self, regions, radius, grid_size=20):
+        """Runs binary on the regions of all victims at once
+
+        Args:
+            @regions: list with the projected polygon of each victim, None
+                      for victims that were not found
+            @radius: the radius of the disk to perform the cuts
+
+        Returns:
+            a list with the distance of each estimate from the real
+            location in m, None for victims that were not found
+        """
+        vb.vb_print(self.verbose, "Running Multi-victim Binary", "UDP", True)
+
+        active = [i for (i, region) in enumerate(regions) if region is not None]
+        last_area = dict((i, float('inf')) for i in active)
+        stalls = dict((i, 0) for i in active)
+        R = radius * 1000
+
+        while len(active) > 0 and self.attack_queries < self.query_limit:
+            vb.vb_print(self.verbose, "Estimating shared cut", "UDP", True)
+            (proj_coords, bits) = raster.best_shared_cut([regions[i]
+                                                          for i in active], R)
+            circle = Point(proj_coords[0], proj_coords[1]).buffer(R)
+
+            # only the victims whose region the circle splits learn
+            # anything from the answer, the rest are not asked
+            inside = {}
+            fraction = {}
+            for i in active:
+                part = regions[i].intersection(circle)
+                if 0 < part.area < regions[i].area:
+                    inside[i] = part
+                    fraction[i] = part.area / regions[i].area
+            asked = [i for i in active if i in inside]
+            if len(asked) == 0:
+                vb.vb_print(self.verbose,
+                            "No region is split by the cut",
+                            "UDP",
+                            True)
+                break
+
+            self.steps.append("DUDP", {"query": self.attack_queries,
+                                       "disk": self._log_kml("disk",
+                                                             circle),
+                                       "expected_bits": bits,
+                                       "victims": asked})
+
+            (query_lon, query_lat) = self.proj(proj_coords[0],
+                                               proj_coords[1],
+                                               inverse=True)
+            self._place_at_coords(self.attacker,
+                                  query_lat,
+                                  query_lon,
+                                  self.test_id)
+
+            answers = self._ask_all([self.victims[i] for i in asked])
+            for (i, answer) in zip(asked, answers):
+                if answer is True:
+                    inter_new = inside[i]
+                else:
+                    inter_new = regions[i].difference(circle)
+
+                if inter_new.is_empty:
+                    print "\n\n\t ***WARNING!! EMPTY INTERSECTION***\n\n"
+                    inter_new = circle
+                regions[i] = self._bound_region(inter_new)
+                self._log_kml("inter_" + str(i), regions[i])
+
+                # stop cutting regions that are small enough, or no longer
+                # significantly reduced by a cut that split them in about
+                # half. A cut chosen for the other victims may only shave a
+                # sliver off, later cuts can still target this one
+                area = regions[i].area
+                lo = self.MULTI_SPLIT_BAND
+                if math.fabs(last_area[i] - area) < self.MIN_REDUCTION * area:
+                    stalls[i] += 1
+                else:
+                    stalls[i] = 0
+                if (area <= self.BINARY_STOP_AREA or
+                        stalls[i] >= self.MAX_STALLS or
+                        (stalls[i] > 0 and lo <= fraction[i] <= 1 - lo)):
+                    active.remove(i)
+                last_area[i] = area
+
+        accuracy = []
+        for (i, victim) in enumerate(self.victims):
+            if regions[i] is None:
+                accuracy.append(None)
+            else:
+                accuracy.append(self._report_estimate(regions[i], victim))
+        return accuracy
+
+    def dudp_attack(self, disk_radii, kml=None, grid_size=20):
+        """Runs a DUDP attack against all victims
+
+        Args:
+            disk_radii: the list of available radii for the disks used
+                        by the service in km
+
+        Returns:
+            a list with the distance of each estimate from the real
+            location in m, None for victims that were not found
+        """
+        self.grid_size = grid_size
+
+        try:
+            found = self._run_coverage(disk_radii)
+            regions = [disk[0] if disk is not None else None
+                       for disk in found]
+            radii = [disk[1] for disk in found if disk is not None]
+            if len(radii) == 0:
+                return [None] * len(self.victims)
+
+            # cut with the largest disk a victim was found in
+            return self._run_binary(regions, max(radii))
+        finally:
+            self._close_artifacts()
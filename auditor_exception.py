@@ -14,9 +14,15 @@ class AuditorException(Exception):
         @log_data:  any data that the caller wants to save (optional)
         @user_id :  the user who executed the query that
                     caused the exception (optional)
+
+    @log_data may also be one of const.FAILURE to tell the auditor how to
+    recover from the failure, e.g. AuditorException(const.FAILURE.BLOCKED)
     """
 
     def __init__(self, log_data=None, username=None):
+        # kept so the framework can tell what kind of failure this was
+        self.log_data = log_data
+        self.username = username
         self._db = AuditorDB()
         self._db.connect()
         # log any data passed
@@ -5,6 +5,79 @@ import auditor_constants as const
 from libs import verbose as vb
 from time import time
 
+class ResponseCache(object):
+    """Distances returned by the service, reused while neither user moves
+
+    The same distance is returned by the service as long as the attacker
+    and the victim stay where they are, so responses are keyed by the
+    attacker, the location it queries from and the time of its last move,
+    and by the victim and the time of its last move. Entries expire after
+    @ttl seconds, and are dropped as soon as one of their users is moved
+    by the auditor. Failed queries are not cached, so their failure reaches
+    the retry logic of the attacks. Only distances are kept, so answers
+    that depend on oracle parameters such as the disk radius are derived
+    from them anew.
+
+    The oracles of an auditor share a single cache, see shared.
+    """
+
+    def __init__(self, ttl=300):
+        """Args:
+            ttl: seconds a response is reused for
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self.hits = 0
+
+    @classmethod
+    def shared(cls, auditor):
+        """Returns the cache of @auditor, creating it and registering it
+        with the move hooks of @auditor the first time
+        """
+        cache = getattr(auditor, "response_cache", None)
+        if cache is None:
+            cache = cls()
+            auditor.response_cache = cache
+            auditor.move_hooks.append(cache.invalidate)
+        return cache
+
+    @staticmethod
+    def key(auditor_user_a, auditor_user_b):
+        loc = auditor_user_a.loc
+        return (auditor_user_a.user, loc[0], loc[1],
+                auditor_user_a.last_updated,
+                auditor_user_b.user, auditor_user_b.last_updated)
+
+    def get(self, auditor_user_a, auditor_user_b):
+        """Returns the cached distance of the users, or None
+        """
+        key = self.key(auditor_user_a, auditor_user_b)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        (dist, stored) = entry
+        if time() - stored > self.ttl:
+            self._entries.pop(key, None)
+            return None
+        self.hits += 1
+        return dist
+
+    def put(self, auditor_user_a, auditor_user_b, dist):
+        """Stores the distance of the users, unless the query failed
+        """
+        if dist is not None:
+            self._entries[self.key(auditor_user_a, auditor_user_b)] = (dist,
+                                                                      time())
+
+    def invalidate(self, auditor_user):
+        """Drops the responses involving @auditor_user, who has just moved
+        """
+        # moves of concurrent attackers may arrive from several threads
+        for key in [k for k in list(self._entries)
+                    if auditor_user.user in (k[0], k[4])]:
+            self._entries.pop(key, None)
+
+
 class ProximityOracle(object):
     """Generic proximity oracle class
 
@@ -24,6 +97,75 @@ class ProximityOracle(object):
         """
         raise AttributeError('in_proximity undefined in child class')
 
+    def _distance(self, auditor_user_a, auditor_user_b, test_id):
+        """Distance of the users as returned by the service, from the
+        response cache of the oracle if there is one
+
+        Returns:
+            (distance, queries), @distance being None if the query failed
+        """
+        cache = getattr(self, "cache", None)
+        if cache is not None:
+            dist = cache.get(auditor_user_a, auditor_user_b)
+            if dist is not None:
+                vb.vb_print(self.verbose, " |-- cached", None, True)
+                return (dist, 0)
+        query_id = self.auditor.next_query_id()
+        (dist, q) = self.auditor.auditor_handled_distance(auditor_user_a,
+                                                          auditor_user_b,
+                                                          test_id,
+                                                          auditor_user_a.loc,
+                                                          query_id)
+        if cache is not None:
+            cache.put(auditor_user_a, auditor_user_b, dist)
+        return (dist, q)
+
+    def _distances(self, auditor_user_a, auditor_users, test_id):
+        """Bulk _distance: only the users whose distance is not cached are
+        queried, with a single query if the auditor supports it
+        """
+        cache = getattr(self, "cache", None)
+        if cache is None:
+            dists = [None] * len(auditor_users)
+        else:
+            dists = [cache.get(auditor_user_a, user) for user in auditor_users]
+        missing = [i for (i, dist) in enumerate(dists) if dist is None]
+        if len(missing) == 0:
+            return (dists, 0)
+
+        query_id = self.auditor.next_query_id()
+        (found, q) = self.auditor.auditor_handled_distances(
+            auditor_user_a,
+            [auditor_users[i] for i in missing],
+            test_id,
+            auditor_user_a.loc,
+            query_id)
+        for (i, dist) in zip(missing, found):
+            dists[i] = dist
+            if cache is not None:
+                cache.put(auditor_user_a, auditor_users[i], dist)
+        return (dists, q)
+
+    def in_proximity_many(self, auditor_user_a, auditor_users, test_id):
+        """Examines the oracle for each of @auditor_users
+
+        Inherited classes may override this to answer for all users with
+        fewer queries. Falls back to in_proximity for each user.
+
+        Returns:
+            (answers, queries) where @answers holds the answer of the oracle
+            for each of @auditor_users
+        """
+        answers = []
+        total = 0
+        for auditor_user_b in auditor_users:
+            (answer, queries) = self.in_proximity(auditor_user_a,
+                                                  auditor_user_b,
+                                                  test_id)
+            answers.append(answer)
+            total += queries
+        return (answers, total)
+
 class DiskProximityOracle(ProximityOracle):
     """Defines a disk proximity oracle
     """
@@ -34,6 +176,7 @@ class DiskProximityOracle(ProximityOracle):
         self.auditor = auditor
         self.radius = radius
         self.verbose = verbose
+        self.cache = ResponseCache.shared(auditor)
 
     def set_radius(self, radius):
         """Set the radius for a DUDP-behavior-like oracle
@@ -55,15 +198,10 @@ class DiskProximityOracle(ProximityOracle):
         """
 
         vb.vb_print(self.verbose, "Examining oracle:", "DUDP", True)
-        query_id = int(time())
-        (dist, q) = self.auditor.auditor_handled_distance(auditor_user_a,
-                                                          auditor_user_b,
-                                                          test_id,
-                                                          auditor_user_a.loc,
-                                                          query_id)
+        (dist, q) = self._distance(auditor_user_a, auditor_user_b, test_id)
         if dist is None:
             vb.vb_print(self.verbose, " |-- None", "DUDP", True)
-            return (None, 1)
+            return (None, q)
         if dist < self.radius:
             vb.vb_print(self.verbose, " |-- True", "DUDP", True)
             return (True, q)
@@ -71,6 +209,27 @@ class DiskProximityOracle(ProximityOracle):
             vb.vb_print(self.verbose, " |-- False", "DUDP", True)
             return (False, q)
 
+    def in_proximity_many(self, auditor_user_a, auditor_users, test_id):
+        """auditor_user_a examines which of @auditor_users are in proximity
+        using the bulk distance query of the auditor when available
+
+        Returns:
+            (answers, queries) where @answers holds True, False or None for
+            each of @auditor_users
+        """
+        if not self.auditor.has_bulk_distances():
+            return ProximityOracle.in_proximity_many(self,
+                                                     auditor_user_a,
+                                                     auditor_users,
+                                                     test_id)
+
+        vb.vb_print(self.verbose, "Examining oracle (bulk):", "DUDP", True)
+        (dists, q) = self._distances(auditor_user_a, auditor_users, test_id)
+        answers = [None if dist is None else dist < self.radius
+                   for dist in dists]
+        vb.vb_print(self.verbose, " |-- " + str(answers), "DUDP", True)
+        return (answers, q)
+
 
 class RoundingProximityOracle(ProximityOracle):
     """Defines a rounding proximity oracle
@@ -89,6 +248,7 @@ class RoundingProximityOracle(ProximityOracle):
         self.auditor = auditor
         self.round_cl = rounding_classes
         self.verbose = verbose
+        self.cache = ResponseCache.shared(auditor)
 
     def in_proximity(self, auditor_user_a, auditor_user_b, test_id):
         """auditor_user_a gets the distance from auditor_user_b
@@ -100,9 +260,12 @@ class RoundingProximityOracle(ProximityOracle):
         """
 
         vb.vb_print(self.verbose, "Examining oracle:", "RUDP", True)
-        query_id = int(time())
-        return self.auditor.auditor_handled_distance(auditor_user_a,
-                                                     auditor_user_b,
-                                                     test_id,
-                                                     auditor_user_a.loc,
-                                                     query_id)
+        return self._distance(auditor_user_a, auditor_user_b, test_id)
+
+    def in_proximity_many(self, auditor_user_a, auditor_users, test_id):
+        """auditor_user_a gets the distances from all of @auditor_users,
+        with a single query if the auditor implements bulk distances
+        """
+
+        vb.vb_print(self.verbose, "Examining oracle:", "RUDP", True)
+        return self._distances(auditor_user_a, auditor_users, test_id)
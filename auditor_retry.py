@@ -0,0 +1,130 @@
+"""Recovery from failed queries
+"""
+from __future__ import absolute_import
+import random
+import re
+
+import auditor_constants as const
+
+# patterns of the exception log data that identify each kind of failure,
+# matched on word boundaries so that e.g. "accurate" is not a rate limit
+FAILURE_PATTERNS = [
+    (const.FAILURE.RATE_LIMITED, (r"rate[ _-]?limit\w*", r"429",
+                                  r"too many (requests|queries)",
+                                  r"throttl\w*", r"slow down")),
+    (const.FAILURE.BLOCKED, (r"blocked", r"banned", r"suspended", r"403",
+                             r"forbidden", r"unauthori[sz]ed",
+                             r"(account|user) (is )?disabled")),
+    (const.FAILURE.STALE_LOCATION, (r"stale", r"check[ -]?in",
+                                    r"(location|position) (is )?"
+                                    r"(outdated|expired|too old)")),
+]
+FAILURE_KEYWORDS = [(kind, re.compile(r"\b(%s)\b" % "|".join(patterns)))
+                    for (kind, patterns) in FAILURE_PATTERNS]
+
+
+def classify(failure):
+    """Returns the kind of failure (one of const.FAILURE) of the
+    AuditorException @failure, or TRANSIENT if there was no exception or its
+    log data does not tell
+    """
+    if failure is None:
+        return const.FAILURE.TRANSIENT
+    log_data = getattr(failure, "log_data", None)
+    if log_data is None:
+        return const.FAILURE.TRANSIENT
+    # log data can be any response of the service, e.g. a dict or a list
+    if isinstance(log_data, basestring) and log_data in const.FAILURE:
+        return log_data
+    text = str(log_data).lower()
+    for (kind, keywords) in FAILURE_KEYWORDS:
+        if keywords.search(text) is not None:
+            return kind
+    return const.FAILURE.TRANSIENT
+
+
+class RetryPolicy(object):
+    """Decides how to recover from each failed query
+
+    Transient failures are retried from the same account with jittered
+    exponential backoff, and the query is handed over to another account
+    once @max_attempts of them happen in a row. A rate limited account
+    holds off for the (longer) rate limit backoff while another account
+    takes over, a blocked one is retired straight away and an account whose
+    location went stale is placed again before the query is repeated.
+
+    Every failure is counted in the metrics attribute.
+    """
+
+    def __init__(self, base=1.0, factor=2.0, max_delay=60.0, max_attempts=5,
+                 rate_base=30.0, seed=None):
+        """Args:
+            base: delay in sec before the first retry of a transient failure
+            factor: growth of the delay with each consecutive failure
+            max_delay: maximum delay in sec
+            max_attempts: consecutive transient failures of an account
+                          before the query is handed over to another one
+            rate_base: delay in sec before a rate limited account is used
+                       again
+            seed: seed of the jitter
+        """
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.rate_base = rate_base
+        self._random = random.Random(seed)
+        self.metrics = {"queries": 0,
+                        "failures": dict((kind, 0) for kind in const.FAILURE),
+                        "recoveries": dict((action, 0)
+                                           for action in const.RECOVERY),
+                        "backoff": 0.0}
+
+    def backoff(self, base, attempt):
+        """Jittered exponential backoff in sec for the @attempt-th
+        consecutive failure
+        """
+        delay = min(self.max_delay, base * self.factor ** (attempt - 1))
+        # full jitter keeps accounts that failed together from retrying
+        # in lockstep
+        return self._random.uniform(0, delay)
+
+    def succeeded(self):
+        """Records a successful query
+        """
+        self.metrics["queries"] += 1
+
+    def recover(self, failure, attempt):
+        """Records a failed query and decides how to recover from it
+
+        Args:
+            failure: the AuditorException raised by the query, or None if
+                     the query failed without one
+            attempt: consecutive failures of the query so far
+
+        Returns:
+            (kind, action, delay) where @kind is one of const.FAILURE,
+            @action one of const.RECOVERY and @delay the seconds the account
+            should wait before its next query
+        """
+        kind = classify(failure)
+        if kind == const.FAILURE.BLOCKED:
+            (action, delay) = (const.RECOVERY.RETIRE, 0.0)
+        elif kind == const.FAILURE.RATE_LIMITED:
+            (action, delay) = (const.RECOVERY.ROTATE,
+                               self.backoff(self.rate_base, attempt) +
+                               self.rate_base)
+        elif kind == const.FAILURE.STALE_LOCATION:
+            (action, delay) = (const.RECOVERY.RELOCATE, 0.0)
+        elif attempt >= self.max_attempts:
+            (action, delay) = (const.RECOVERY.ROTATE,
+                               self.backoff(self.base, attempt))
+        else:
+            (action, delay) = (const.RECOVERY.RETRY,
+                               self.backoff(self.base, attempt))
+
+        self.metrics["queries"] += 1
+        self.metrics["failures"][kind] += 1
+        self.metrics["recoveries"][action] += 1
+        self.metrics["backoff"] += delay
+        return (kind, action, delay)
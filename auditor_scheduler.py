@@ -0,0 +1,210 @@
+"""Attacker scheduling
+"""
+from __future__ import absolute_import
+from collections import deque
+from time import time
+
+from libs import earth
+
+
+def travel_wait(user, lat, lon, speed_limit, now=None):
+    """Seconds @user has to wait before moving to [@lat, @lon] without
+    exceeding @speed_limit (in km/h), given their current location and the
+    time of their last move
+
+    Users that have not been placed yet, or services without a speed limit,
+    never have to wait
+    """
+    if speed_limit is None or user.loc is None or user.loc[0] is None:
+        return 0.0
+    if now is None:
+        now = time()
+    dist = earth.distance_on_unit_sphere(user.loc[0], user.loc[1], lat, lon)
+    # time (in sec) needed to cover the distance at the speed limit
+    travel = dist / float(speed_limit) * 3600
+    return max(0.0, travel - (now - user.last_updated))
+
+
+class QueryBudget(object):
+    """Per account query usage against the limits of the service
+
+    The limits found by the query limit test apply to each account. Usage
+    is tracked in memory so accounts can be rotated out just before they
+    reach a limit instead of after getting blocked: an account that used
+    @margin of the absolute limit is exhausted, and one that used @margin
+    of its allowance of the rate limit in the last @window seconds is
+    paused until enough of those queries fall out of the window.
+    """
+
+    def __init__(self, absq_limit=None, qps_limit=None, margin=0.9,
+                 window=60):
+        """Args:
+            absq_limit: total queries allowed per account, or None
+            qps_limit: queries per second allowed per account, or None
+            margin: fraction of the limits the accounts are allowed to use
+            window: length in sec of the window the rate is measured over
+        """
+        self.absq_limit = absq_limit
+        self.qps_limit = qps_limit
+        self.margin = margin
+        self.window = window
+        # queries of each account since the budget was created
+        self.used = {}
+        # (time, queries) of each account within the last window
+        self.recent = {}
+        # time until which each account was told to hold off by the service
+        self.held = {}
+
+    def charge(self, user, queries=1, now=None):
+        """Records @queries issued by @user
+        """
+        if queries <= 0:
+            return
+        if now is None:
+            now = time()
+        self.used[user] = self.used.get(user, 0) + queries
+        self.recent.setdefault(user, deque()).append((now, queries))
+
+    def hold(self, user, seconds, now=None):
+        """Pauses @user for @seconds, e.g. after the service rate limited it
+        """
+        if now is None:
+            now = time()
+        self.held[user] = max(self.held.get(user, 0), now + seconds)
+
+    def usage(self, user):
+        """Queries issued by @user so far
+        """
+        return self.used.get(user, 0)
+
+    def exhausted(self, user):
+        """True if @user is about to reach the absolute query limit
+        """
+        if self.absq_limit is None:
+            return False
+        return self.usage(user) >= self.margin * self.absq_limit
+
+    def pause(self, user, now=None):
+        """Seconds @user has to wait before its next query to stay below
+        the rate limit, or until the end of its hold
+        """
+        if now is None:
+            now = time()
+        held = max(0.0, self.held.get(user, 0) - now)
+        if self.qps_limit is None or user not in self.recent:
+            return held
+        recent = self.recent[user]
+        while len(recent) > 0 and recent[0][0] <= now - self.window:
+            recent.popleft()
+        allowance = max(1, int(self.margin * self.qps_limit * self.window))
+        excess = sum(q for (_, q) in recent) - allowance + 1
+        # wait until the oldest queries covering the excess expire
+        for (issued, queries) in recent:
+            if excess <= 0:
+                break
+            excess -= queries
+            if excess <= 0:
+                return max(held, issued + self.window - now)
+        return held
+
+
+class AttackerScheduler(object):
+    """Chooses which of the attacker accounts is placed at each location
+
+    Instead of cycling through the accounts in a fixed order, every
+    placement goes to the account that can reach the target soonest
+    without exceeding the speed limit of the service, i.e. the one for which
+    the distance from its current location is covered by the time passed
+    since its last move. With a few accounts spread over the search area
+    most placements need no wait at all. Waits for the rate limit of
+    @budget count as well, and among accounts that are ready at the same
+    time the least used one is chosen, so the load is spread over the pool.
+
+    Accounts that fail or exhaust their budget are retired; once all of
+    them have been retired the pool is restored and the restarts attribute
+    is increased.
+    """
+
+    def __init__(self, attackers, speed_limit=None, budget=None):
+        """Args:
+            attackers: the AuditorUser instances that can be used as attackers
+            speed_limit: the speed limit of the service in km/h, or None
+            budget: the QueryBudget of the accounts, by default without
+                    limits
+        """
+        self.speed_limit = speed_limit
+        self.budget = budget if budget is not None else QueryBudget()
+        self.pool = list(attackers)
+        self.active = list(attackers)
+        self.restarts = 0
+
+    def wait(self, user, lat=None, lon=None, now=None):
+        """Seconds @user has to wait before it can be placed at [@lat, @lon]
+        and query the service
+        """
+        if now is None:
+            now = time()
+        wait = self.budget.pause(user, now)
+        if lat is not None and lon is not None:
+            wait = max(wait, travel_wait(user, lat, lon, self.speed_limit,
+                                         now))
+        return wait
+
+    def charge(self, user, queries=1):
+        """Records @queries issued by @user, retiring them if they are about
+        to reach the absolute query limit
+        """
+        self.budget.charge(user, queries)
+        if self.budget.exhausted(user):
+            self.retire(user)
+
+    def spent(self, user):
+        """True if @user should hand its next query over to another account
+        """
+        return (user not in self.active or
+                self.budget.exhausted(user) or
+                self.budget.pause(user) > 0)
+
+    def _distance(self, user, lat, lon):
+        if user.loc is None or user.loc[0] is None:
+            return float('inf')
+        return earth.distance_on_unit_sphere(user.loc[0], user.loc[1],
+                                             lat, lon)
+
+    def choose(self, lat=None, lon=None, exclude=()):
+        """Returns the active account that can be placed at [@lat, @lon]
+        and query soonest, together with the seconds it has to wait for
+        that. Ties are broken in favour of the least used account and then
+        of the closest one. If no location is given only the rate limit is
+        taken into account. Accounts in @exclude are not considered, and
+        (None, 0) is returned if no other account is active.
+        """
+        if len(self.active) == 0:
+            fresh = [u for u in self.pool if not self.budget.exhausted(u)]
+            # if every account is exhausted, go on with the whole pool
+            self.active = fresh if len(fresh) > 0 else list(self.pool)
+            self.restarts += 1
+
+        now = time()
+        ranks = []
+        for (i, user) in enumerate(self.active):
+            if user in exclude:
+                continue
+            if lat is None or lon is None:
+                dist = 0
+            else:
+                dist = self._distance(user, lat, lon)
+            ranks.append((self.wait(user, lat, lon, now),
+                          self.budget.usage(user),
+                          dist,
+                          i))
+        if len(ranks) == 0:
+            return (None, 0.0)
+        (wait, _, _, best) = min(ranks)
+        return (self.active[best], wait)
+
+    def retire(self, user):
+        """Removes @user from the accounts used until the next restart
+        """
+        if user in self.active:
+            self.active.remove(user)
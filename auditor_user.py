@@ -1,7 +1,8 @@
 """User class
 """
 from __future__ import absolute_import
-from time import time
+from calendar import timegm
+from time import strptime, time
 
 from auditor_db import AuditorDB
 
@@ -10,9 +11,15 @@ class AuditorUser(object):
 
     Each AuditorUser instance contains the user as passed by the inherited
     class, as well as metadata about the user such as queries, location etc
+
+    Instances are plain records: they hold no database connection and are
+    persisted explicitly through UserRegistry.flush
     """
 
-    def __init__(self, service_id, user, location=None):
+    __slots__ = ("user", "service_id", "user_id", "queries", "loc",
+                 "last_updated", "is_active")
+
+    def __init__(self, service_id, user, location=None, info=None):
         """Initializes a user class as used by the auditor
         inh_user is the user instance as passed by the inherited Class
 
@@ -20,65 +27,45 @@ class AuditorUser(object):
             service_id: the id of the service as defined in db
             user: the username of the user for that service
             location: location in [lat, lon] for the user
+            info: the (id, queries, [lat, lon], timestamp) record of the user
+                  in the db. If None, the user is fetched from the db
         """
-
-        # initialize database
-        self._db = AuditorDB()
-        self._db.connect()
-
-        # insert in db if not exists
-        if location is not None:
-            self._db.insert_user(user, service_id, location[0], location[1])
-        else:
-            self._db.insert_user(user, service_id, None, None)
-
         # load user info from inherited class
         self.user = user
         self.service_id = service_id
         # mark this Auditor user as inactive until used in an experiment
         self.is_active = False
-        # will be set in _restore_from_db
         self.user_id = None
-        self.loc = None
+        self.loc = [None, None]
+        self.last_updated = 0
+        self.queries = 0
+
+        if info is None:
+            _db = AuditorDB()
+            _db.connect()
+            # insert in db if not exists
+            if location is not None:
+                _db.insert_user(user, service_id, location[0], location[1])
+            else:
+                _db.insert_user(user, service_id, None, None)
+            info = _db.fetch_user_info(user, service_id)
+            _db.close_connection()
 
         # update user info from the latest record in db
-        if not self._restore_from_db():
-            self.last_updated = 0
-            self.queries = 0
+        if info is not None:
+            self.user_id, self.queries, self.loc, self.last_updated = info
+            # the db keeps the time of the last move as a UTC timestamp
+            if isinstance(self.last_updated, basestring):
+                self.last_updated = timegm(strptime(self.last_updated,
+                                                    "%Y-%m-%d %H:%M:%S"))
+            elif self.last_updated is None:
+                self.last_updated = 0
 
         # if location was provided at init
         # overwrite whatever was provided by the database
         if location is not None:
             self.loc = location
 
-    def __del__(self):
-        """Update user record on db before cleanup
-        """
-        if self.loc[0] is not None and self.loc[1] is not None:
-            self._db.update_user(self.user_id,
-                                 False,
-                                 self.queries,
-                                 self.loc[0],
-                                 self.loc[1])
-        else:
-            self._db.update_user(self.user_id,
-                                 False,
-                                 self.queries,
-                                 None,
-                                 None)
-        self._db.close_connection()
-
-    def _restore_from_db(self):
-        """Fetch user information from database
-        """
-        _db_info = self._db.fetch_user_info(self.user, self.service_id)
-
-        if _db_info is None:
-            return False
-        else:
-            self.user_id, self.queries, self.loc, self.last_updated = _db_info
-            return True
-
     def update_location(self, lat, lon):
         """Update location in memory
         """
@@ -89,3 +76,49 @@ class AuditorUser(object):
         """Update queries in memory
         """
         self.queries += queries
+
+
+class UserRegistry(object):
+    """The AuditorUser instances of a service
+
+    Users are loaded from the database in a single batch the first time
+    they are requested and the same instance is returned to every test
+    afterwards, so their queries and location carry over between tests.
+    Changes are written back in a single batch by flush.
+    """
+
+    def __init__(self, db, service_id):
+        """Args:
+            db: a connected AuditorDB instance
+            service_id: the id of the service of the users
+        """
+        self._db = db
+        self.service_id = service_id
+        self._users = {}
+
+    def get_many(self, users):
+        """Returns the AuditorUser instances of the usernames @users
+        """
+        missing = [u for u in users if u not in self._users]
+        if len(missing) > 0:
+            self._db.insert_users(missing, self.service_id)
+            infos = self._db.fetch_users_info(missing, self.service_id)
+            for user in missing:
+                self._users[user] = AuditorUser(self.service_id,
+                                                user,
+                                                info=infos.get(user))
+        return [self._users[u] for u in users]
+
+    def get(self, user):
+        """Returns the AuditorUser instance of the username @user
+        """
+        return self.get_many([user])[0]
+
+    def flush(self):
+        """Writes the queries and location of all users to the db
+        """
+        records = [(False, u.queries, u.loc[0], u.loc[1],
+                    int(u.last_updated), u.user_id)
+                   for u in self._users.itervalues()
+                   if u.user_id is not None]
+        self._db.update_users(records)
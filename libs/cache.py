@@ -0,0 +1,90 @@
+"""On-disk cache of projected search areas and hexagonal grids
+"""
+from __future__ import absolute_import
+import hashlib
+import io
+import os
+
+import numpy as np
+from shapely import wkb
+
+
+class GeometryCache(object):
+    """Caches the projected search area of a kml file as WKB and the grid
+    points built over it as packed numpy arrays.
+
+    Entries are keyed by a hash of the kml content and of the projection
+    definition (and of the radius for grids), so a changed kml file or a
+    different projection never hits a stale entry.
+    """
+
+    # directory to hold the cached files
+    CACHE_DIR = "files/cache/"
+
+    def __init__(self, proj, cache_dir=None):
+        self.proj = proj
+        if cache_dir is None:
+            cache_dir = ''.join(os.getcwd() + "/" + self.CACHE_DIR)
+        self.cache_dir = cache_dir
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _write(self, path, data):
+        """Write @data to @path atomically so that concurrent attacks never
+        read a partial file
+        """
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "wb") as outfile:
+            outfile.write(data)
+        os.rename(tmp, path)
+
+    def area_key(self, kml_file):
+        """Returns the key of the search area in @kml_file
+        """
+        digest = hashlib.sha1()
+        with open(kml_file, "rb") as kmlf:
+            for chunk in iter(lambda: kmlf.read(1 << 16), b""):
+                digest.update(chunk)
+        digest.update(self.proj.srs.encode("utf-8"))
+        return digest.hexdigest()
+
+    def search_area(self, kml_file, loader, key=None):
+        """Returns the projected search area of @kml_file
+
+        Args:
+            @kml_file: the kml file with the search area
+            @loader:   function parsing and projecting @kml_file, called on
+                       a cache miss
+            @key:      the area_key of @kml_file if already known
+        """
+        if key is None:
+            key = self.area_key(kml_file)
+        path = self._path("area_" + key + ".wkb")
+        if os.path.isfile(path):
+            with open(path, "rb") as infile:
+                return wkb.loads(infile.read())
+
+        area = loader(kml_file)
+        self._write(path, wkb.dumps(area))
+        return area
+
+    def grid(self, key, R, builder):
+        """Returns the (N, 2) array of grid points of radius @R (in m) for
+        the search area with key @key
+
+        Args:
+            @builder: function returning the grid points, called on a miss
+        """
+        digest = hashlib.sha1((key + ":" + repr(float(R))).encode("utf-8"))
+        path = self._path("grid_" + digest.hexdigest() + ".npy")
+        if os.path.isfile(path):
+            return np.load(path)
+
+        centres = np.asarray(builder(), dtype=np.int64).reshape(-1, 2)
+        packed = io.BytesIO()
+        np.save(packed, centres)
+        self._write(path, packed.getvalue())
+        return centres
@@ -4,13 +4,24 @@ from __future__ import absolute_import
 import sys
 import math
 from math import sqrt
-from shapely.geometry import LineString, Polygon, Point
-import random
+from shapely.geometry import Polygon, Point, MultiPolygon
+from shapely.ops import transform, triangulate
+from shapely import prepared, vectorized
+import numpy as np
 
 from . import projections
+from . import raster
 
-def circle(lat, lon, R, proj):
+# size in m of the grid that the vertices of active regions are snapped to
+PRECISION = 0.01
+
+def circle(lat, lon, R, proj, error_field=None):
+    """Returns the projected circle of radius @R (in m) at (@lat, @lon),
+    corrected for the error of the projection if @error_field is given
+    """
     (x, y) = proj(lon, lat)
+    if error_field is not None:
+        R += float(error_field.error(x, y, R))
     return Point(x, y).buffer(R)
 
 def check_if_in(proj, poly, point, is_latlon = True):
@@ -34,7 +45,14 @@ def check_if_in(proj, poly, point, is_latlon = True):
             is_in = False
             return is_in
 
-def cut(poly, proj, R, grid):
+def _line_errors(proj, xs, ys, R):
+    """Projection errors for the distance @R (in m) at the projected points
+    (@xs, @ys), computed with a single batch of projection calls
+    """
+    lonlat = projections.unproject(proj, np.column_stack((xs, ys)))
+    return projections.proj_errors(proj, lonlat[:, 1], lonlat[:, 0], R, 0)
+
+def cut(poly, proj, R, grid, correct=True, error_field=None):
     """Takes a polygon and a radius R and returns the coordinates
     of a circle (p;R) which cuts the polygon in half.
     The returned coordinates are in projected plane.
@@ -43,7 +61,13 @@ def cut(poly, proj, R, grid):
     @proj: 	projection used
     @R: 	radius of circle used for cutting in km
     @grid_point_dist: the distance of point to be used in the grid
-    @err_adj: account for errors of the projection
+    @correct: account for errors of the projection. Can be skipped for
+              projections that preserve distances in the area of @poly
+    @error_field: a projections.ErrorField to interpolate the projection
+                  errors from instead of computing them
+
+    The projection error along the line the circle slides on is sampled in
+    one batch and interpolated at each step of the search.
     """
     R = R * 1000
 
@@ -65,6 +89,13 @@ def cut(poly, proj, R, grid):
         # circle for various cases and we perform a binary search
         min_pos = py = miny - R
         max_pos = maxy - R
+        samples = np.linspace(min_pos, max_pos, 64)
+        if correct and error_field is not None:
+            errors = error_field.error(px, samples, R)
+        elif correct:
+            errors = _line_errors(proj, np.full(len(samples), px), samples, R)
+        else:
+            errors = np.zeros(len(samples))
 
         it = 0 # debug purposes
         best_py = py
@@ -72,12 +103,11 @@ def cut(poly, proj, R, grid):
         while min_pos < max_pos:
             py = (min_pos + max_pos) / 2
             cut_area = 0
-            (lon, lat) = proj(px, py, inverse = True)
-            R += projections.proj_error(proj, [lat, lon], R, 0)
-            cut_circle = Point(px, py).buffer(R)
+            cut_circle = Point(px, py).buffer(R + np.interp(py, samples,
+                                                            errors))
 
             if poly.geom_type == "MultiPolygon":
-                for p in poly:
+                for p in poly.geoms:
                     cut_inter = p.intersection(cut_circle)
                     cut_area += cut_inter.area
             else:
@@ -107,6 +137,13 @@ def cut(poly, proj, R, grid):
         # circle for various cases and we perform a binary search
         min_pos = px = minx - R
         max_pos = maxx - R
+        samples = np.linspace(min_pos, max_pos, 64)
+        if correct and error_field is not None:
+            errors = error_field.error(samples, py, R)
+        elif correct:
+            errors = _line_errors(proj, samples, np.full(len(samples), py), R)
+        else:
+            errors = np.zeros(len(samples))
         it = 0
 
         # keep best out of iterations
@@ -115,11 +152,10 @@ def cut(poly, proj, R, grid):
         while min_pos < max_pos:
             px = (min_pos + max_pos) / 2
             cut_area = 0
-            (lon, lat) = proj(px, py, inverse = True)
-            R += projections.proj_error(proj, [lat, lon], R, 0)
-            cut_circle = Point(px, py).buffer(R)
+            cut_circle = Point(px, py).buffer(R + np.interp(px, samples,
+                                                            errors))
             if poly.geom_type == "MultiPolygon":
-                for p in poly:
+                for p in poly.geoms:
                     cut_inter = p.intersection(cut_circle)
                     cut_area += cut_inter.area
             else:
@@ -140,33 +176,189 @@ def cut(poly, proj, R, grid):
         # Get best of all
         px = best_px
 
-    (lon, lat) = proj(px, py, inverse=True)
-    print "\t\tCutting from " + str([lat, lon])
     return [px, py]
 
-def get_random_points_in_polygon(poly, N):
-    """Gets at most N distinct points from within polygon poly
-    Attention: randomness is not strong
+def cut_raster(poly, proj, R, cells=raster.GRID_CELLS, directions=32,
+               correct=True, error_field=None):
+    """Takes a polygon and a radius R and returns the coordinates
+    of a circle (p;R) which cuts the polygon in half.
+    The returned coordinates are in projected plane.
+
+    Unlike cut, which only slides the circle along one axis through the
+    centre of the bounding box, the polygon is rasterised into an occupancy
+    grid and a batch of candidate centres in @directions directions is
+    scored at once against a disk kernel.
+
+    @poly: 	polygon to be cut in half (in PROJECTED COORDINATES)
+    @proj: 	projection used
+    @R: 	radius of circle used for cutting in km
+    @cells: number of raster cells along the longest side of the polygon
+    @correct: account for errors of the projection, as in cut
+    @error_field: a projections.ErrorField to interpolate the projection
+                  errors from instead of computing them
+
+    The candidate disks are corrected by the projection error at the
+    centroid of @poly, which barely changes across an active region.
+    """
+    R = R * 1000
+    centre = poly.centroid
+    if correct and error_field is not None:
+        R += float(error_field.error(centre.x, centre.y, R))
+    elif correct:
+        R += float(_line_errors(proj, np.array([centre.x]),
+                                np.array([centre.y]), R)[0])
+
+    return raster.best_cut(poly, R, cells, directions)[0]
+
+class PolygonSampler(object):
+    """Uniform sampler of points inside a projected (multi)polygon
+
+    Points are drawn in batches with numpy and the ones falling outside of
+    the polygon are rejected, so the samples are exactly uniform. A few
+    points are drawn from the bounding box of the polygon. Once more than
+    TRIANGULATE_MIN points are requested, the polygon is triangulated and
+    points are drawn from the triangles instead, picking a triangle with
+    probability proportional to its area and a uniform point inside it,
+    which is accepted far more often. The triangulation is not constrained
+    to the polygon, so the triangles that cross its border are kept as
+    well and rejection takes care of their outside parts.
     """
-    INVALID_X = -9999
-    INVALID_Y = -9999
 
-    (minx, miny, maxx, maxy) = poly.bounds
-    count = 0
-    points = []
+    # fewest points requested at once for which the polygon is triangulated
+    TRIANGULATE_MIN = 1000
 
-    if N <=0:
+    def __init__(self, poly, seed=None):
+        """Args:
+            @poly: projected polygon or multipolygon to sample from
+            @seed: optional seed of the random generator
+        """
+        self.poly = poly
+        self.rng = np.random.RandomState(seed)
+        self.vertices = None
+        self.weights = None
+        (minx, miny, maxx, maxy) = poly.bounds
+        self.bounds = np.array([[minx, miny], [maxx, maxy]])
+        box_area = (maxx - minx) * (maxy - miny)
+        self.acceptance = max(poly.area / box_area if box_area > 0 else 0,
+                              1e-3)
+
+    def _triangulate(self):
+        """Keeps the triangles of the triangulation of the polygon that
+        overlap it
+        """
+        triangles = triangulate(self.poly)
+        vertices = np.array([tri.exterior.coords[:3] for tri in triangles])
+        if len(triangles) > 0:
+            centres = vertices.mean(axis=1)
+            keep = vectorized.contains(self.poly, centres[:, 0],
+                                       centres[:, 1])
+            # triangles whose centre is outside may still cross the border.
+            # All vertices lie on the border, so the triangles are shrunk a
+            # little to tell crossing ones from the ones that only touch it
+            inside = prepared.prep(self.poly)
+            for i in np.flatnonzero(~keep):
+                shrunk = centres[i] + 0.99 * (vertices[i] - centres[i])
+                keep[i] = inside.intersects(Polygon(shrunk))
+            vertices = vertices[keep]
+        if len(vertices) == 0:
+            # degenerate polygon, fall back to its bounding box
+            return
+
+        a = vertices[:, 1] - vertices[:, 0]
+        b = vertices[:, 2] - vertices[:, 0]
+        areas = np.fabs(a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]) / 2
+        self.vertices = vertices
+        self.weights = areas / areas.sum()
+        # fraction of the triangulated area that lies in the polygon
+        self.acceptance = max(self.poly.area / areas.sum(), 1e-3)
+
+    def _draw(self, count):
+        """Draws @count uniform points from the union of the triangles, or
+        from the bounding box if the polygon has not been triangulated
+        """
+        if self.vertices is None:
+            return self.bounds[0] + (self.rng.random_sample((count, 2)) *
+                                     (self.bounds[1] - self.bounds[0]))
+        tris = self.vertices[self.rng.choice(len(self.vertices), count,
+                                             p=self.weights)]
+        (u, v) = self.rng.random_sample((2, count))
+        # reflect the points of the parallelogram back into the triangle
+        flip = u + v > 1
+        u[flip] = 1 - u[flip]
+        v[flip] = 1 - v[flip]
+        return (tris[:, 0] + u[:, None] * (tris[:, 1] - tris[:, 0]) +
+                v[:, None] * (tris[:, 2] - tris[:, 0]))
+
+    def sample(self, count):
+        """Returns an (@count, 2) array of uniform points inside the polygon
+        """
+        if self.vertices is None and count >= self.TRIANGULATE_MIN:
+            self._triangulate()
+        points = np.empty((0, 2))
+        while len(points) < count:
+            missing = count - len(points)
+            batch = self._draw(int(missing / self.acceptance) + 1)
+            keep = vectorized.contains(self.poly, batch[:, 0], batch[:, 1])
+            points = np.vstack((points, batch[keep][:missing]))
         return points
 
-    while count < N:
-        p = Point(INVALID_X, INVALID_Y)
-        while not poly.contains(p):
-            p_x = random.uniform(minx, maxx)
-            p_y = random.uniform(miny, maxy)
-            p = Point(p_x, p_y)
-            points.append((p_x, p_y))
-            count += 1
-            return points
+def get_random_points_in_polygon(poly, N, seed=None):
+    """Gets N uniformly random points from within polygon poly
+    """
+    if N <= 0:
+        return []
+    return [tuple(p) for p in PolygonSampler(poly, seed).sample(N).tolist()]
+
+def vertex_count(poly):
+    """Returns the total number of vertices of a (multi)polygon, holes
+    included
+    """
+    if poly.is_empty:
+        return 0
+    if poly.geom_type == "MultiPolygon":
+        return sum(vertex_count(p) for p in poly.geoms)
+    if poly.geom_type != "Polygon":
+        return 0
+    return (len(poly.exterior.coords) +
+            sum(len(r.coords) for r in poly.interiors))
+
+def simplify_region(poly, tolerance, precision=PRECISION):
+    """Bounds the complexity of an active region between attack steps
+
+    Parts and spikes thinner than @tolerance (slivers left by repeated
+    intersections) are removed by a morphological opening, then the region
+    is simplified preserving its topology and its vertices are snapped to a
+    grid of size @precision. If nothing is left, the region is returned
+    unchanged.
+
+    @poly:      projected polygon or multipolygon
+    @tolerance: simplification tolerance in m
+    @precision: size of the snapping grid in m
+    """
+    if poly.is_empty or poly.geom_type not in ("Polygon", "MultiPolygon"):
+        return poly
+
+    # shrinking by half the tolerance wipes out anything thinner than it,
+    # growing back restores the rest; mitred joins keep the corners sharp
+    opened = poly.buffer(-tolerance / 2.0, join_style=2)
+    opened = opened.buffer(tolerance / 2.0, join_style=2)
+    if opened.is_empty:
+        return poly
+
+    simple = opened.simplify(tolerance, preserve_topology=True)
+    snap = lambda x, y, *z: (np.round(np.asarray(x) / precision) * precision,
+                             np.round(np.asarray(y) / precision) * precision)
+    simple = transform(snap, simple)
+    if not simple.is_valid:
+        simple = simple.buffer(0)
+
+    parts = simple.geoms if simple.geom_type == "MultiPolygon" else [simple]
+    parts = [p for p in parts if p.geom_type == "Polygon" and not p.is_empty]
+    if len(parts) == 0:
+        return poly
+    if len(parts) == 1:
+        return parts[0]
+    return MultiPolygon(parts)
 
 def poly_centroid(poly, proj):
     """Returns the real centroid coordinates for a given projected polygon
@@ -175,7 +367,7 @@ def poly_centroid(poly, proj):
     (lon, lat) = proj(float(centr[0]), float(centr[1]), inverse = True)
     return [lat, lon]
 
-def ring(lat, lon, R, r, proj, EC=2.5):
+def ring(lat, lon, R, r, proj, EC=2.5, correct=True, error_field=None):
     """Creates a ring defined by two circles with radiuses r, R
     centered at x, y
 
@@ -185,6 +377,8 @@ def ring(lat, lon, R, r, proj, EC=2.5):
         r: inner radius of the ring in m
         proj. projection used
         EC: correction parameter
+        correct: account for errors of the projection
+        error_field: a projections.ErrorField to interpolate the errors from
     """
     if R == r:
         return None
@@ -193,11 +387,16 @@ def ring(lat, lon, R, r, proj, EC=2.5):
     (x, y) = proj(lon, lat)
 
     # error adjust rings
-    error_r = EC * projections.proj_error(proj, [lat, lon], r, 0)
-    error_R = EC * projections.proj_error(proj, [lat, lon], R, 0)
+    if correct and error_field is not None:
+        error_r = EC * float(error_field.error(x, y, r))
+        error_R = EC * float(error_field.error(x, y, R))
+    elif correct:
+        error_r = EC * projections.proj_error(proj, [lat, lon], r, 0)
+        error_R = EC * projections.proj_error(proj, [lat, lon], R, 0)
 
-    r -= math.fabs(error_r)
-    R += math.fabs(error_R)
+    if correct:
+        r -= math.fabs(error_r)
+        R += math.fabs(error_R)
 
     if R > r:
         outer_circle = Point(x, y).buffer(R)
@@ -210,6 +409,51 @@ def ring(lat, lon, R, r, proj, EC=2.5):
 
     return ring
 
+def hex_lattice(bounds, R):
+    """Returns an (N, 2) array with the vertices of the hexagonal lattice of
+    density @R that covers @bounds, extended by one row/column on each side.
+
+    Rows are 3R/2 apart and every other row is shifted by half the distance
+    between vertices (R * sqrt(3)), so every vertex is the center of a cell
+    whose six neighbours are also lattice vertices.
+    """
+    (minx, miny, maxx, maxy) = bounds
+    R = float(R)
+    grid = R * sqrt(3)
+    gridy = 3 * R / 2
+
+    rows = np.arange(-1, int(math.ceil((maxy - miny) / gridy)) + 2)
+    cols = np.arange(-1, int(math.ceil((maxx - minx) / grid)) + 2)
+    (col, row) = np.meshgrid(cols, rows)
+
+    # even rows start half a cell before minx, odd rows at minx
+    xs = minx - (row % 2 == 0) * grid / 2 + col * grid
+    ys = miny + row * gridy
+    return np.column_stack((xs.ravel(), ys.ravel()))
+
+def hex_centres(poly, R):
+    """Returns the vertices of the hexagonal grid of density @R whose circles
+    of radius @R intersect the polygon @poly as an (N, 2) array of integer
+    projected coordinates.
+
+    All lattice vertices are tested at once: a circle (p; R) intersects
+    @poly iff p lies within distance R of @poly, i.e. inside poly.buffer(R).
+    """
+    centres = hex_lattice(poly.bounds, R)
+    # We are working with ints as the grid points are used as dictionary keys
+    # Not much precision lost since we work on the projection
+    centres = np.trunc(centres).astype(np.int64)
+    # drop duplicates before testing
+    keys = np.ascontiguousarray(centres).view(
+        np.dtype((np.void, centres.dtype.itemsize * 2)))
+    (_, idx) = np.unique(keys, return_index=True)
+    centres = centres[np.sort(idx)]
+
+    near = vectorized.contains(poly.buffer(float(R)),
+                               centres[:, 0].astype(float),
+                               centres[:, 1].astype(float))
+    return centres[near]
+
 class Cells(object):
     """Cell grid with hexagons and polygon implementation
     """
@@ -218,111 +462,14 @@ class Cells(object):
         self.pdict = {}
         self.projection = proj
 
-    def __check_and_add(self, x, y, poly, R):
-        """
-        Checks if the circle (@x, @y, @R) intersects with the polygon @poly
-        If so, it adds the points to the dictionary
-        """
-        if Point(x,y).buffer(R).intersects(poly):
-            self.pdict[(int(x), int(y))] = 1
-
-    def create_cell(self, p_coords, poly, R, pos):
-        """
-        Creates a cell around a point with coordinates @p_coords,
-        for a given cell density R and polygon. Depending on where the point is,
-        not all vertices of its cell have an intersection with the polygon.Thus,
-        when creating the cell, for each vertex ("neighbour") to the point, we
-        need to check whether the corresponding circle of the vertex intersects
-        with the polygon
-
-        @p_coords: 	[lat, lon] for of the point which is the cell center
-        @poly: 		The polygon for which we construct the grid
-        @R: 		The density of the cell grid. This is the radius of each
-        circle in the cell vertices and center
-        @pos: 		Position of the point.
-        """
-        x = p_coords[0]
-        y = p_coords[1]
-        R = float(R)
-        r3= R * sqrt(3)
-        gridy = 3 * R / 2
-
-        self.__check_and_add(x + r3, y, poly, R)
-        self.__check_and_add(x + r3/2, y - gridy, poly, R)
-        self.__check_and_add(x - r3/2, y - gridy, poly, R)
-        self.__check_and_add(x - r3, y, poly, R)
-        self.__check_and_add(x - r3/2, y + gridy, poly, R)
-        self.__check_and_add(x + r3/2, y + gridy, poly, R)
-
-    def cell_points_x(self, poly, inter, grid, R, start_p, ypoint):
-        """
-        Creates cells in a line parallel to x axis passing through point ypoint
-
-        @poly:  	the polygon we are gcreating the grid in
-        @inter: 	is the intersection of the parallel line with the polygon
-        @grid: 		the distance between vertices in the x axis
-        @R: 		the radius of each circle places in a vertex
-        @start_p: 	starting point for the cell. The grid has to be consistent,
-        so it does not always start at the beginning of the
-        intersection with the polygon
-        """
-        ipoints = list(inter.coords)
-
-        # Get minimux x of intersection
-        minx = ipoints[0][0]
-        maxx = ipoints[-1][0]
-
-        # align intersection with grid
-        start = minx + grid - (minx - start_p) % grid
-
-        # get the starting point
-        i = start
-
-        # Go all the way up to maxx + grid as we check for intersection with
-        # a circle of size grid
-        while (i < maxx + grid):
-            # Add point to grid
-            # We are working with ints because we are using a dictionary
-            # Not much precision lost since we work on the projection
-            self.pdict[(int(i), int(ypoint))] = 1
-            self.create_cell((i, ypoint), poly, R, 0)
-            i += grid
-
     def construct_grid_in_polygon(self, poly, R):
         """
         Constructs a cell-like grid inside a polygon
         @poly: 	the polygon
         @R: 	the radius of the circle to be placed on each vertex in m
         """
-        (minx, miny, maxx, maxy) = poly.bounds
-
-        xpoint = minx
-        ypoint = miny
-
-        # only increase y by 3*R/2 and take parallel horizontal lines
-        grid = float(R) * sqrt(3)
-        grid_start = [xpoint - grid/2, xpoint]
-        grid_pos = 0
-
-        #FIXME do we need extra iteration in y?
-        while ypoint <= maxy:
-            grid_s = grid_start[grid_pos]
-
-            # get interseciton points of current parallel with the multipolygon
-            line = LineString([(minx, ypoint), (maxx, ypoint)])
-            inter = poly.intersection(line)
-
-            if inter.geom_type == "Point":
-                coords = list(inter.coords)
-
-            if inter.geom_type == "LineString":
-                self.cell_points_x(poly, inter, grid, R, grid_s, ypoint)
-            elif inter.geom_type == "MultiLineString":
-                for line in inter.geoms:
-                    self.cell_points_x(poly, line, grid, R, grid_s, ypoint)
-
-            grid_pos = 1 - grid_pos
-            ypoint += 3 * float(R) / 2
+        for (x, y) in hex_centres(poly, R):
+            self.pdict[(int(x), int(y))] = 1
 
     def construct_grid_in_circle(self, x, y, R, r):
         """Creates a grid of cells inside a circle of radius R centered around
@@ -0,0 +1,187 @@
+"""Disk cover planning for the coverage phase of DUDP
+"""
+from __future__ import absolute_import
+import heapq
+import math
+
+import numpy as np
+from shapely.geometry import Point
+from shapely.ops import unary_union
+
+from . import cells
+from . import raster
+
+# maximum number of sample points used to represent the polygon
+MAX_SAMPLES = 40000
+
+# quadrant segments of the polygons approximating the disks when the cover
+# is checked. The polygons are inscribed in the disks, so gaps narrower than
+# twice the sagitta R (1 - cos(pi / (4 * DISK_SEGMENTS))) are chord artefacts
+DISK_SEGMENTS = 32
+
+# repair rounds for the parts of the polygon left uncovered
+MAX_REPAIRS = 10
+
+# radii that need more than MAX_CANDIDATES hexagonal grid points to cover
+# the polygon are too small for the area and are not considered
+MAX_CANDIDATES = 20000
+
+
+def _disk_members(sample_ids, xs, ys, res, x, y, R):
+    """Returns the ids of the samples within @R of (x, y)
+
+    Only the window of the raster (with cells of size @res) around the disk
+    is examined
+    """
+    c0 = max(int(math.floor((x - R - xs[0]) / res)), 0)
+    c1 = min(int(math.ceil((x + R - xs[0]) / res)) + 1, len(xs))
+    r0 = max(int(math.floor((y - R - ys[0]) / res)), 0)
+    r1 = min(int(math.ceil((y + R - ys[0]) / res)) + 1, len(ys))
+    if c0 >= c1 or r0 >= r1:
+        return np.empty(0, dtype=np.int64)
+
+    window = sample_ids[r0:r1, c0:c1]
+    dx2 = (xs[c0:c1] - x) ** 2
+    dy2 = (ys[r0:r1] - y) ** 2
+    inside = (dy2[:, None] + dx2[None, :] <= R * R) & (window >= 0)
+    return window[inside]
+
+
+def _parts(geom):
+    """Returns the polygons of @geom
+    """
+    if geom.is_empty:
+        return []
+    if hasattr(geom, "geoms"):
+        return [g for g in geom.geoms if g.geom_type == "Polygon"]
+    if geom.geom_type == "Polygon":
+        return [geom]
+    return []
+
+
+def uncovered(poly, plan):
+    """Returns the parts of @poly outside of every disk (x, y, R) of @plan,
+    ignoring the slivers due to the polygonal approximation of the disks
+    """
+    if len(plan) == 0:
+        return poly
+    disks = unary_union([Point(x, y).buffer(R, DISK_SEGMENTS)
+                         for (x, y, R) in plan])
+    sagitta = max(R for (_, _, R) in plan) * (
+        1 - math.cos(math.pi / (4 * DISK_SEGMENTS)))
+    return poly.difference(disks).buffer(-sagitta).buffer(sagitta)
+
+
+def _gap_disks(gap, radii):
+    """Returns disks (x, y, R) covering the polygon @gap: the smallest
+    single disk centred at its envelope if one is large enough, or the
+    hexagonal grid of the largest radius otherwise
+    """
+    centre = gap.envelope.centroid
+    reach = max(centre.distance(Point(p)) for p in gap.exterior.coords)
+    for R in sorted(radii):
+        if R >= reach:
+            return [(centre.x, centre.y, float(R))]
+    R = float(max(radii))
+    return [(float(x), float(y), R) for (x, y) in cells.hex_centres(gap, R)]
+
+
+def repair_cover(poly, plan, radii):
+    """Returns the disks to add to @plan so that it covers all of @poly
+    """
+    extra = []
+    for _ in range(MAX_REPAIRS):
+        gaps = _parts(uncovered(poly, plan + extra))
+        if len(gaps) == 0:
+            break
+        for gap in gaps:
+            extra.extend(_gap_disks(gap, radii))
+    return extra
+
+
+def plan_disk_cover(poly, radii, centres_for=None, max_samples=MAX_SAMPLES,
+                    max_candidates=MAX_CANDIDATES):
+    """Computes a near-minimum set of disks of mixed radii covering @poly
+
+    The polygon is represented by a set of raster sample points and the
+    candidate disks are the hexagonal grids of every radius. Disks are
+    then picked greedily (set cover), each time taking the disk covering
+    the most samples that are not yet covered. On ties the smaller radius
+    wins, so borders are covered by small disks that reach less outside
+    the polygon. Parts of the polygon left between the samples are then
+    covered by extra disks, queried last.
+
+    Args:
+        @poly:        projected polygon to be covered
+        @radii:       the available radii in m
+        @centres_for: function returning the candidate centres for a radius,
+                      defaults to cells.hex_centres(poly, R)
+        @max_samples: number of sample points used to represent @poly
+        @max_candidates: maximum grid points per radius
+
+    Returns:
+        (plan, expected) where @plan is a list of disks (x, y, R) in the
+        order they should be queried and @expected is the expected number
+        of queries until a victim, placed uniformly in @poly, is found.
+    """
+    if centres_for is None:
+        centres_for = lambda R: cells.hex_centres(poly, R)
+
+    (minx, miny, maxx, maxy) = poly.bounds
+    res = max(min(radii) / 2.0,
+              math.sqrt((maxx - minx) * (maxy - miny) / float(max_samples)))
+    (mask, xs, ys, res) = raster.rasterize(poly, resolution=res)
+
+    sample_ids = np.full(mask.shape, -1, dtype=np.int64)
+    total = int(mask.sum())
+    sample_ids[mask] = np.arange(total)
+    if total == 0:
+        # polygon is smaller than a single raster cell
+        point = poly.representative_point()
+        plan = [(point.x, point.y, float(max(radii)))]
+        return plan + repair_cover(poly, plan, radii), 1.0
+
+    # candidate disks and the samples each one covers
+    disks = []
+    members = []
+    for R in sorted(set(float(r) for r in radii)):
+        centres = centres_for(R)
+        if len(centres) == 0 or len(centres) > max_candidates:
+            continue
+        for (x, y) in centres:
+            ids = _disk_members(sample_ids, xs, ys, res, float(x), float(y), R)
+            if len(ids) > 0:
+                disks.append((float(x), float(y), R))
+                members.append(ids)
+
+    # lazy greedy set cover: gains only decrease as samples get covered,
+    # so a stale gain in the heap is an upper bound of the real one
+    covered = np.zeros(total, dtype=bool)
+    heap = [(-len(ids), disks[i][2], i) for (i, ids) in enumerate(members)]
+    heapq.heapify(heap)
+
+    plan = []
+    gains = []
+    left = total
+    while heap and left > 0:
+        (neg_gain, R, i) = heapq.heappop(heap)
+        gain = int((~covered[members[i]]).sum())
+        if gain == 0:
+            continue
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, R, i))
+            continue
+        covered[members[i]] = True
+        left -= gain
+        plan.append(disks[i])
+        gains.append(gain)
+
+    # samples only approximate the polygon: cover whatever is left between
+    # them, so the whole area is guaranteed to be covered
+    extra = repair_cover(poly, plan, radii)
+    plan.extend(extra)
+    gains.extend([0] * len(extra))
+
+    # the victim is found at the i-th disk with probability gain_i / total
+    expected = sum((i + 1) * g for (i, g) in enumerate(gains)) / float(total)
+    return plan, expected
@@ -1,6 +1,7 @@
 import math
 
 from math import radians, cos, sin, asin, sqrt
+import numpy as np
 
 #FIXME cleanup & check correctness
 """
@@ -107,3 +108,71 @@ def get_middle_point(coord1, coord2):
     lon3 = math.degrees(lon3)
 
     return [lat3, lon3]
+
+
+#
+#   Vectorised versions of the above. All arguments may be numpy arrays (or
+#   scalars) and are broadcast against each other, so that a single call
+#   handles any number of points
+#
+
+def distances_on_unit_sphere(lat1, lon1, lat2, lon2):
+    """
+    Great circle distances in km between the points (@lat1, @lon1) and
+    (@lat2, @lon2), as in distance_on_unit_sphere
+    """
+    lat1 = np.radians(lat1)
+    lon1 = np.radians(lon1)
+    lat2 = np.radians(lat2)
+    lon2 = np.radians(lon2)
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    # rounding may push a slightly above 1 for antipodal points
+    c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return RADIUS * c
+
+def points_on_earth(lat, lon, dist, brng):
+    """
+    Get the points at distance @dist (in km) and bearing @brng (in degrees)
+    from (@lat, @lon), as in point_on_earth
+
+    Returns:
+        (lats, lons) arrays in degrees
+    """
+    brng = np.radians(90.0 - np.asarray(brng, dtype=float))
+    ang = np.asarray(dist, dtype=float) / RADIUS
+
+    lat1 = np.radians(lat)
+    lon1 = np.radians(lon)
+
+    lat2 = np.arcsin(np.sin(lat1) * np.cos(ang) +
+                     np.cos(lat1) * np.sin(ang) * np.cos(brng))
+    lon2 = lon1 + np.arctan2(np.sin(brng) * np.sin(ang) * np.cos(lat1),
+                             np.cos(ang) - np.sin(lat1) * np.sin(lat2))
+
+    return np.degrees(lat2), np.degrees(lon2)
+
+def middle_points(lat1, lon1, lat2, lon2):
+    """
+    Get the middle points between (@lat1, @lon1) and (@lat2, @lon2), as in
+    get_middle_point
+
+    Returns:
+        (lats, lons) arrays in degrees
+    """
+    dlon = np.radians(np.asarray(lon2, dtype=float) - lon1)
+
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    lon1 = np.radians(lon1)
+
+    bx = np.cos(lat2) * np.cos(dlon)
+    by = np.cos(lat2) * np.sin(dlon)
+
+    lat3 = np.arctan2(np.sin(lat1) + np.sin(lat2),
+                      np.sqrt((np.cos(lat1) + bx) ** 2 + by * by))
+    lon3 = lon1 + np.arctan2(by, np.cos(lat1) + bx)
+
+    return np.degrees(lat3), np.degrees(lon3)
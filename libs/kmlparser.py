@@ -3,14 +3,14 @@
 from __future__ import absolute_import
 
 import os
-import random
-from shapely.geometry import Point, Polygon, MultiPolygon
+import numpy as np
+from shapely.geometry import Polygon, MultiPolygon
 from pykml.factory import KML_ElementMaker as KML
-from pykml import parser as kparser
 from pykml.parser import Schema
 from lxml import etree
 
-from . import vector
+from . import cells
+from . import projections
 
 class KMLParser(object):
     """KML/MultiPolygon conversions
@@ -18,36 +18,66 @@ class KMLParser(object):
 
     schema_gx = Schema("kml22gx.xsd")
 
+    KML_NS = "{http://www.opengis.net/kml/2.2}"
+    # coordinates of the outer boundary relative to a Polygon element
+    OUTER_COORDINATES = (KML_NS + "outerBoundaryIs/" + KML_NS + "LinearRing/" +
+                         KML_NS + "coordinates")
+
     def __init__(self, projection):
         self.proj = projection
+        # sampler of random points of the last polygon used
+        self._sampler = None
 
-    def _create_placemark(self, polygon):
+    @staticmethod
+    def _parse_coordinates(text):
+        """Parses the text of a kml coordinates element into an (N, 2) array
+        of [lon, lat], ignoring any z coordinate
+        """
+        # tuples are either lon,lat or lon,lat,z. The stride is taken from
+        # the first tuple and all values are parsed at once
+        points = text.split()
+        if len(points) == 0:
+            return np.empty((0, 2))
+        dims = points[0].count(",") + 1
+        if text.count(",") == len(points) * (dims - 1):
+            values = np.fromstring(text.replace(",", " "), sep=" ")
+            if len(values) == len(points) * dims:
+                return values.reshape(-1, dims)[:, :2]
+        # 2-D and 3-D tuples are mixed
+        return np.array([point.split(",")[:2] for point in points],
+                        dtype=float).reshape(-1, 2)
+
+    def _ring_coords(self, ring):
+        """Returns the kml coordinates string of a projected linear ring,
+        unprojecting all of its vertices with a single call
+        """
+        lonlat = projections.unproject(self.proj, ring.coords).tolist()
+        return "".join(str(lon) + "," + str(lat) + " " for (lon, lat) in lonlat)
+
+    def _create_placemark(self, polygon, name=None):
         """Creates placemark node from projected polygon
 
         Args:
             @polygon: the polygon to provide coordinates from the placemark
+            @name:    optional name of the placemark
         """
         placemark = KML.Placemark()
+        if name is not None:
+            placemark.append(KML.name(name))
 
         # get exterior
-        exterior = ""
-        for coords in polygon.exterior.coords:
-            (lon, lat) = self.proj(coords[0], coords[1], inverse=True)
-            exterior += vector.to_str([lon, lat]) + " "
-            kmlpoly = KML.Polygon()
-            outer_boundary = KML.outerBoundaryIs(
-                KML.LinearRing(
-                    KML.coordinates(exterior)
-                )
+        exterior = self._ring_coords(polygon.exterior)
+        kmlpoly = KML.Polygon()
+        outer_boundary = KML.outerBoundaryIs(
+            KML.LinearRing(
+                KML.coordinates(exterior)
             )
-            kmlpoly.append(outer_boundary)
+        )
+        kmlpoly.append(outer_boundary)
 
         # get interior (holes in the polygon)
         for linear_ring in polygon.interiors:
-            interior = ""
-            for coords in linear_ring.coords:
-                (lon, lat) = self.proj(coords[0], coords[1], inverse=True)
-                interior += vector.to_str([lon, lat]) + " "
+            interior = self._ring_coords(linear_ring)
 
             inner_boundary = KML.innerBoundaryIs(
                 KML.LinearRing(
@@ -55,11 +85,30 @@ class KMLParser(object):
                 )
             )
             kmlpoly.append(inner_boundary)
-            placemark.append(kmlpoly)
+        placemark.append(kmlpoly)
 
         return placemark
 
 
+    def placemarks(self, poly, name=None):
+        """Returns the placemarks of a projected (multi)polygon, one for
+        each of its parts
+
+        Args:
+            @poly: the polygon to be represented
+            @name: optional name of the placemarks
+        """
+        if poly.geom_type == "MultiPolygon":
+            parts = poly.geoms
+        elif poly.geom_type == "Polygon":
+            parts = [poly]
+        else:
+            # e.g. an empty or a degenerate intersection
+            parts = [part for part in getattr(poly, "geoms", [])
+                     if part.geom_type == "Polygon"]
+
+        return [self._create_placemark(part, name) for part in parts]
+
     def kml_from_poly(self, cut_poly, kmlfile):
         """Creates a kml file in lat/lon coordinates from polygon whose
         coordinates are in projected x/y coordinates
@@ -72,77 +121,15 @@ class KMLParser(object):
             KML.Document(
             )
         )
-        if cut_poly.geom_type == "MultiPolygon":
-            for p in cut_poly:
-                pm = KML.Placemark()
-
-                c = ""
-                for coords in p.exterior.coords:
-                        (lon, lat) = self.proj(coords[0],
-                                               coords[1],
-                                               inverse = True)
-                        # TODO add flags for inverse
-                        c += str(lon) + "," + str(lat) + " "
-                poly = KML.Polygon()
-                ob =  KML.outerBoundaryIs(
-                            KML.LinearRing(
-                                KML.coordinates(c)
-                            )
-                        )
-                poly.append(ob)
-
-                for linear_ring in p.interiors:
-                    cin = ""
-                    for c in linear_ring.coords:
-                        (lon, lat) = self.proj(c[0], c[1], inverse = True)
-                        # TODO add flags for inverse
-                        cin += str(lon) + "," + str(lat) + " "
-
-                    ib =  KML.innerBoundaryIs(
-                                KML.LinearRing(
-                                    KML.coordinates(cin)
-                                )
-                            )
-                    poly.append(ib)
-                pm.append(poly)
-                kml.Document.append(pm)
-        else:
-            pm = KML.Placemark()
-
-            c = ""
-            for coords in cut_poly.exterior.coords:
-                    (lon, lat) = self.proj(coords[0], coords[1], inverse = True)
-                    # TODO add flags for inverse
-                    c += str(lon) + "," + str(lat) + " "
-            poly = KML.Polygon()
-            ob =  KML.outerBoundaryIs(
-                        KML.LinearRing(
-                            KML.coordinates(c)
-                        )
-                    )
-            poly.append(ob)
-
-            for linear_ring in cut_poly.interiors:
-                cin = ""
-                for c in linear_ring.coords:
-                    (lon, lat) = self.proj(c[0], c[1], inverse = True)
-                    # TODO add flags for inverse
-                    cin += str(lon) + "," + str(lat) + " "
-
-                ib =  KML.innerBoundaryIs(
-                            KML.LinearRing(
-                                KML.coordinates(cin)
-                            )
-                        )
-                poly.append(ib)
-            pm.append(poly)
-            kml.Document.append(pm)
+        for placemark in self.placemarks(cut_poly):
+            kml.Document.append(placemark)
 
+        data = etree.tostring(kml, pretty_print=True)
         with open(kmlfile, "w") as outfile:
-            outfile.write(etree.tostring(kml, pretty_print=True))
+            outfile.write(data)
 
         # return kml to the caller
-        return etree.tostring(kml, pretty_print=True)
+        return data
 
     def poly_from_kml(self, kml_file):
         """Creates a MultiPOlygon from a kml file
@@ -154,48 +141,54 @@ class KMLParser(object):
         Args:
             @kml_file: the kml file to be parsed
         """
-        xpath_poly = ".//{http://www.opengis.net/kml/2.2}Polygon"
-
         if not os.path.isfile(kml_file):
             raise SystemExit("No such file")
 
-        with open(kml_file) as kmlf:
-            doc = kparser.parse(kmlf).getroot()
-            multi = []
-            for polygon in doc.Document.findall(xpath_poly):
-                boundary = []
-                boundstr = polygon.outerBoundaryIs.LinearRing.coordinates
-                # get outer boundaries of polygon
-                for poly in str(boundstr).rstrip().split(' '):
-                    # transform with given projection
-                    coords = poly.split(',')
-                    # we ignore z coordinate
-                    # XXX this assumes that coords are in format [lon, lat]!
-                    coords = self.proj(float(coords[0]), float(coords[1]))
-                    # add to polygon
-                    boundary.append(coords)
-                multi.append(Polygon(boundary))
+        # a single streaming pass keeping only the outer boundaries.
+        # Elements are dropped as soon as they are read so that memory does
+        # not grow with the size of the file
+        boundaries = []
+        for (_, polygon) in etree.iterparse(kml_file, events=("end",),
+                                            tag=self.KML_NS + "Polygon"):
+            coordinates = polygon.find(self.OUTER_COORDINATES)
+            if coordinates is not None and coordinates.text:
+                boundary = self._parse_coordinates(coordinates.text)
+                if len(boundary) > 0:
+                    boundaries.append(boundary)
+            polygon.clear()
+            # everything before the polygon, i.e. its preceding siblings and
+            # those of its Placemark and Folders, has been processed as well
+            elem = polygon
+            while elem is not None:
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+                elem = elem.getparent()
+
+        if len(boundaries) == 0:
+            return MultiPolygon()
+
+        # transform all vertices with given projection at once
+        lengths = [len(boundary) for boundary in boundaries]
+        coords = projections.project(self.proj, np.vstack(boundaries))
+        multi = [Polygon(boundary) for boundary in
+                 np.split(coords, np.cumsum(lengths)[:-1])]
 
         return MultiPolygon(multi)
 
-    def random_from_polygon(self, poly, points_no):
-        """Gets at most N distinct points from within polygon poly
-        """
-        (minx, miny, maxx, maxy) = poly.bounds
-        count = 0
-        points = []
+    def random_from_polygon(self, poly, points_no, seed=None):
+        """Gets @points_no uniformly random points from within polygon poly
+
+        The sampler of the last polygon is kept, so once it has been
+        triangulated for a large batch, repeated calls for the same polygon
+        are cheap
 
+        Args:
+            @seed: optional seed to make the points reproducible
+        """
         if points_no <= 0:
-            return points
-
-        p_x = random.uniform(minx, maxx)
-        p_y = random.uniform(miny, maxy)
-        point = Point(p_x, p_y)
-        while count < points_no:
-            while not poly.contains(point):
-                p_x = random.uniform(minx, maxx)
-                p_y = random.uniform(miny, maxy)
-                point = Point(p_x, p_y)
-            points.append((p_x, p_y))
-            count += 1
-        return points
+            return []
+
+        if (self._sampler is None or self._sampler.poly is not poly or
+                seed is not None):
+            self._sampler = cells.PolygonSampler(poly, seed)
+        return [tuple(p) for p in self._sampler.sample(points_no).tolist()]
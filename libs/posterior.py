@@ -0,0 +1,209 @@
+"""Probabilistic location estimation on a posterior grid
+"""
+from __future__ import absolute_import
+import math
+
+import numpy as np
+from shapely import vectorized
+from shapely.geometry import Point
+from shapely.ops import unary_union
+
+from . import raster
+
+# maximum number of cells of the posterior grid
+MAX_CELLS = 2 ** 18
+
+# cells with less posterior mass than this are dropped when the grid is
+# cropped and re-rasterised at a finer resolution
+NEGLIGIBLE_MASS = 1e-6
+
+
+class PosteriorGrid(object):
+    """Probability grid over the possible locations of a victim
+
+    Every oracle answer is treated as evidence instead of ground truth:
+    an answer is assumed to be wrong with probability @error_rate, so
+    each response multiplies the cells that agree with it by
+    (1 - error_rate) and the rest by error_rate. A single wrong answer thus
+    only lowers the probability of the true location instead of ruling
+    it out.
+
+    The area and centroid attributes refer to the credible region and the
+    posterior mean respectively, so the grid can be reported like any
+    other active region.
+    """
+
+    def __init__(self, support, error_rate=0.05, resolution=1.0,
+                 credibility=0.95, max_cells=MAX_CELLS):
+        """Initializes a uniform posterior over @support
+
+        Args:
+            @support:     projected polygon outside of which the victim is
+                          assumed not to be
+            @error_rate:  probability that an oracle answer is wrong
+            @resolution:  finest cell size in m
+            @credibility: posterior mass of the credible region
+            @max_cells:   maximum number of cells of the grid
+        """
+        self.support = support
+        self.error_rate = float(error_rate)
+        self.resolution = float(resolution)
+        self.credibility = credibility
+        self.max_cells = max_cells
+        # every observation as (likelihood function, arguments) so the
+        # posterior can be rebuilt on a finer grid
+        self.observations = []
+        self._rasterize(support.bounds)
+
+    def _rasterize(self, window):
+        """(Re)builds the grid over @window applying all observations
+        """
+        (minx, miny, maxx, maxy) = window
+        res = max(self.resolution,
+                  math.sqrt((maxx - minx) * (maxy - miny) /
+                            float(self.max_cells)))
+        (xs, ys, self.cell) = raster.cell_centres(window, res)
+        (grid_x, grid_y) = np.meshgrid(xs, ys)
+        inside = vectorized.contains(self.support, grid_x, grid_y)
+        if not inside.any():
+            # thin support, keep its representative point
+            point = self.support.representative_point()
+            (grid_x, grid_y) = (np.array([point.x]), np.array([point.y]))
+            inside = np.array([True])
+
+        self.points = np.column_stack((grid_x[inside], grid_y[inside]))
+        self.log_prob = np.zeros(len(self.points))
+        for (likelihood, args) in self.observations:
+            self.log_prob += likelihood(*args)
+        self._normalize()
+
+    def _normalize(self):
+        self.log_prob -= self.log_prob.max()
+        self.prob = np.exp(self.log_prob)
+        self.prob /= self.prob.sum()
+
+    def _agree(self, agrees):
+        """Log likelihood of each cell given whether it agrees with an answer
+        """
+        return np.where(agrees,
+                        math.log(1 - self.error_rate),
+                        math.log(self.error_rate))
+
+    def _disk_likelihood(self, x, y, R, answer):
+        dist2 = ((self.points - [x, y]) ** 2).sum(axis=1)
+        return self._agree((dist2 <= float(R) * R) == answer)
+
+    def _ring_likelihood(self, x, y, r, R):
+        dist2 = ((self.points - [x, y]) ** 2).sum(axis=1)
+        return self._agree((dist2 >= float(r) * r) & (dist2 <= float(R) * R))
+
+    def _observe(self, likelihood, *args):
+        self.observations.append((likelihood, args))
+        self.log_prob += likelihood(*args)
+        self._normalize()
+        self._refine()
+
+    def observe_disk(self, x, y, R, answer):
+        """Updates the posterior with the answer of a disk oracle for the
+        disk (x, y; R), @answer being True if the victim was in proximity
+        """
+        self._observe(self._disk_likelihood, x, y, R, bool(answer))
+
+    def _region_likelihood(self, region):
+        inside = vectorized.contains(region, self.points[:, 0],
+                                     self.points[:, 1])
+        return self._agree(inside)
+
+    def observe_region(self, region):
+        """Updates the posterior with a response placing the victim inside
+        the projected polygon @region
+        """
+        self._observe(self._region_likelihood, region)
+
+    def observe_ring(self, x, y, r, R):
+        """Updates the posterior with a ring response, i.e. the victim is
+        at distance between @r and @R (in m) from (x, y)
+        """
+        self._observe(self._ring_likelihood, x, y, r, R)
+
+    def _credible_cells(self):
+        """Returns the indices of the smallest set of cells holding
+        @credibility of the posterior mass
+        """
+        order = np.argsort(self.prob)[::-1]
+        mass = np.cumsum(self.prob[order])
+        count = int(np.searchsorted(mass, self.credibility)) + 1
+        return order[:count]
+
+    def _refine(self):
+        """Crops the grid to the cells with non negligible mass and
+        re-rasterises it if that allows for a twice finer resolution
+        """
+        if self.cell <= self.resolution:
+            return
+        live = self.points[self.prob > NEGLIGIBLE_MASS]
+        half = self.cell / 2
+        window = (live[:, 0].min() - half, live[:, 1].min() - half,
+                  live[:, 0].max() + half, live[:, 1].max() + half)
+        res = math.sqrt((window[2] - window[0]) * (window[3] - window[1]) /
+                        float(self.max_cells))
+        if max(res, self.resolution) * 2 <= self.cell:
+            self._rasterize(window)
+
+    @property
+    def area(self):
+        """Area of the credible region in m^2
+        """
+        return len(self._credible_cells()) * self.cell * self.cell
+
+    @property
+    def centroid(self):
+        """Posterior mean of the victim location
+        """
+        (x, y) = np.dot(self.prob, self.points)
+        return Point(x, y)
+
+    def to_polygon(self):
+        """Returns the credible region as a polygon for KML export
+        """
+        half = self.cell / 2
+        boxes = [Point(x, y).buffer(half, cap_style=3)
+                 for (x, y) in self.points[self._credible_cells()]]
+        return unary_union(boxes)
+
+    def _sample(self, max_points):
+        """Returns at most @max_points cells with non negligible mass, taken
+        with a regular stride, and their renormalised probabilities
+        """
+        live = np.flatnonzero(self.prob > NEGLIGIBLE_MASS)
+        if len(live) > max_points:
+            live = live[::int(math.ceil(len(live) / float(max_points)))]
+        prob = self.prob[live]
+        return self.points[live], prob / prob.sum()
+
+    def information_gain(self, centres, R, max_points=raster.GRID_CELLS ** 2):
+        """Expected information gain, in bits, of asking the disk oracle
+        about a disk of radius @R centred at each of @centres
+
+        The posterior is subsampled to @max_points cells to keep the cost
+        of scoring a batch of candidates bounded
+        """
+        (points, prob) = self._sample(max_points)
+        mass = raster.disk_counts(points, centres, R, prob)
+        p_yes = (1 - self.error_rate) * mass + self.error_rate * (1 - mass)
+        return (raster.binary_entropy(p_yes) -
+                raster.binary_entropy(self.error_rate))
+
+    def best_query(self, R, cells=raster.GRID_CELLS, directions=32,
+                   offsets=64):
+        """Returns the centre of the disk of radius @R (in m) with the
+        highest expected information gain together with that gain
+        """
+        region = self.points[self._credible_cells()]
+        if len(region) > cells * cells:
+            region = region[::int(math.ceil(len(region) /
+                                            float(cells * cells)))]
+        centres = raster.cut_candidates(region, R, directions, offsets)
+        gain = self.information_gain(centres, R)
+        best = int(np.argmax(gain))
+        return [float(centres[best][0]), float(centres[best][1])], gain[best]
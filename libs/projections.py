@@ -1,9 +1,59 @@
 from __future__ import absolute_import
-from pyproj import Proj
 import math
 
+import numpy as np
+
 from . import earth
 
+# projections already initialised, by definition
+_PROJS = {}
+
+
+def get_proj(init):
+    """Returns the projection for the definition @init, either an init
+    string (e.g. "esri:102005") or a proj4 string, initialising it only the
+    first time it is requested
+    """
+    if init not in _PROJS:
+        _PROJS[init] = _new_proj(init)
+    return _PROJS[init]
+
+
+def _new_proj(init):
+    # pyproj is only loaded once a projection is actually used
+    from pyproj import Proj
+    if init.startswith("+"):
+        return Proj(init)
+    return Proj(init=init)
+
+
+def copy_proj(proj):
+    """Returns a new instance of the projection @proj (a Proj or a
+    LazyProj), e.g. for a thread that must not share the one in use
+    """
+    if isinstance(proj, LazyProj):
+        return _new_proj(proj.init)
+    return _new_proj(proj.srs)
+
+
+class LazyProj(object):
+    """Stands in for the projection with definition @init, which is only
+    created on first use. Calls and attribute accesses are forwarded to the
+    projection, so instances can be used wherever a Proj is expected.
+    """
+
+    def __init__(self, init):
+        self.init = init
+
+    def __call__(self, *args, **kwargs):
+        return get_proj(self.init)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name == "init":
+            # not initialised yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(get_proj(self.init), name)
+
 # lon_0 is the longitude axis which is used to center the projection.
 # unless else noted, the projection's x axis origins at lon_0.
 # lat_0 is used to designate a central parallel and associated y axis origin
@@ -15,41 +65,41 @@ from . import earth
 # USA equidistant conic
 # +proj=eqdc +lat_0=39 +lon_0=-96 +lat_1=33 +lat_2=45 +x_0=0 +y_0=0
 # +datum=NAD83 +units=m +no_defs
-us_eqdc = Proj(init = "esri:102005")
+us_eqdc = LazyProj("esri:102005")
 
-alaska = Proj(init = "esri:102006")
+alaska = LazyProj("esri:102006")
 
 # North America equidistant conic
 #+proj=eqdc +lat_0=40 +lon_0=-96 +lat_1=20 +lat_2=60 +x_0=0 +y_0=0
 #+datum=NAD83 +units=m +no_defs
-na_eqdc = Proj(init = "esri:102010")
+na_eqdc = LazyProj("esri:102010")
 
 # South America equidistant conic
 # +proj=eqdc +lat_0=-32 +lon_0=-60 +lat_1=-5 +lat_2=-42 +x_0=0 +y_0=0
 # +ellps=aust_SA +units=m +no_defs
-sa_eqdc = Proj(init = "esri:102032")
+sa_eqdc = LazyProj("esri:102032")
 
 # Europe equidistant conic
 # +proj=eqdc +lat_0=30 +lon_0=10 +lat_1=43 +lat_2=62 +x_0=0 +y_0=0
 # +ellps=intl +units=m +no_defs
-eu_eqdc = Proj(init = "esri:102031")
+eu_eqdc = LazyProj("esri:102031")
 
 # Asia South equidistant conic
 # +proj=eqdc +lat_0=-15 +lon_0=125 +lat_1=7 +lat_2=-32 +x_0=0 +y_0=0
 # +datum=WGS84 +units=m +no_defs
-as_eqdc = Proj(init = "esri:102029")
+as_eqdc = LazyProj("esri:102029")
 
 # Asia North equidistant conic
 # +proj=eqdc +lat_0=30 +lon_0=95 +lat_1=15 +lat_2=65 +x_0=0 +y_0=0
 # +datum=WGS84 +units=m +no_defs
-an_eqdc = Proj(init = "esri:102026")
+an_eqdc = LazyProj("esri:102026")
 
 # Afrika equidistant conic
 # +proj=eqdc +lat_0=0 +lon_0=25 +lat_1=20 +lat_2=-23 +x_0=0 +y_0=0
 # +datum=WGS84 +units=m +no_defs
-af_eqdc = Proj(init = "esri:102026")
+af_eqdc = LazyProj("esri:102026")
 
-google = Proj(init = "epsg:3857")
+google = LazyProj("epsg:3857")
 
 
 class Projection():
@@ -91,3 +141,131 @@ def proj_error(proj, p, R, angle = 0):
 
     # error is distance in projected coordinates - real
     return math.hypot(px - rx, py - ry) - R
+
+def project(proj, coords, inverse=False):
+    """Projects an (N, 2) array of [lon, lat] coordinates with a single call
+    to @proj, or unprojects an (N, 2) array of [x, y] coordinates if
+    @inverse is set
+
+    Returns:
+        an (N, 2) array with the transformed coordinates
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return coords
+    (xs, ys) = proj(coords[:, 0], coords[:, 1], inverse=inverse)
+    return np.column_stack((xs, ys))
+
+def unproject(proj, coords):
+    """Returns the [lon, lat] coordinates of an (N, 2) array of projected
+    coordinates
+    """
+    return project(proj, coords, inverse=True)
+
+def proj_errors(proj, lats, lons, R, angle=0):
+    """Vectorised proj_error for the points (@lats, @lons) and the
+    distance @R in m
+    """
+    (lats, lons) = np.broadcast_arrays(np.asarray(lats, dtype=float),
+                                       np.asarray(lons, dtype=float))
+    (px, py) = proj(lons.ravel(), lats.ravel())
+    (r_lats, r_lons) = earth.points_on_earth(lats.ravel(), lons.ravel(),
+                                             float(R) / 1000, angle)
+    (rx, ry) = proj(r_lons, r_lats)
+    errors = np.hypot(np.asarray(px) - rx, np.asarray(py) - ry) - R
+    return errors.reshape(lats.shape)
+
+def local_aeqd(lat, lon):
+    """Returns an azimuthal equidistant projection centred at (@lat, @lon)
+
+    The projection uses the same sphere as the earth module. Distances from
+    the centre are exact and the distortion elsewhere grows with the square
+    of the distance from it, so for a metropolitan area centred at its
+    centroid distances are preserved to a few parts in 10^5.
+    """
+    return get_proj("+proj=aeqd +lat_0=%.6f +lon_0=%.6f +R=%d "
+                    "+units=m +no_defs" % (lat, lon, earth.RADIUS * 1000))
+
+def distance_error_bound(proj, bounds, R=1000, samples=8):
+    """Bounds the relative error of distances of @proj within @bounds
+
+    The projection error of a distance @R (in m) is measured in four
+    directions at @samples x @samples points across the projected @bounds
+
+    Returns:
+        the maximum error as a fraction of the distance
+    """
+    (minx, miny, maxx, maxy) = bounds
+    (xs, ys) = np.meshgrid(np.linspace(minx, maxx, samples),
+                           np.linspace(miny, maxy, samples))
+    lonlat = unproject(proj, np.column_stack((xs.ravel(), ys.ravel())))
+    worst = 0.0
+    for angle in (0, 45, 90, 135):
+        errors = proj_errors(proj, lonlat[:, 1], lonlat[:, 0], R, angle)
+        worst = max(worst, float(np.abs(errors).max()))
+    return worst / R
+
+
+class ErrorField(object):
+    """Projection distortion of @proj over an area, sampled once
+
+    The error of a distance R is, to first order, proportional to R, so the
+    field holds the relative error proj_error(p, R) / R at the vertices of a
+    coarse lattice over @bounds and answers queries for any point and
+    radius by bilinear interpolation, without calling the projection.
+    The accuracy attribute holds the largest relative deviation from
+    proj_error measured at the centres of the lattice cells.
+    """
+
+    def __init__(self, proj, bounds, cells=16, R=1000, angle=0):
+        """Samples the error of @proj on a (@cells + 1)^2 lattice over the
+        projected @bounds, for distances of @R m in direction @angle
+        """
+        (minx, miny, maxx, maxy) = bounds
+        self.proj = proj
+        self.angle = angle
+        self.xs = np.linspace(minx, maxx, cells + 1)
+        self.ys = np.linspace(miny, maxy, cells + 1)
+        self.scale = self._sample(self.xs, self.ys, R)
+
+        # measure the interpolation error in the middle of the cells
+        mid_xs = (self.xs[1:] + self.xs[:-1]) / 2
+        mid_ys = (self.ys[1:] + self.ys[:-1]) / 2
+        exact = self._sample(mid_xs, mid_ys, R)
+        (grid_x, grid_y) = np.meshgrid(mid_xs, mid_ys)
+        self.accuracy = float(np.abs(self.scale_error(grid_x, grid_y) -
+                                     exact).max())
+
+    def _sample(self, xs, ys, R):
+        """Relative errors at the lattice with vertices @xs, @ys
+        """
+        (grid_x, grid_y) = np.meshgrid(xs, ys)
+        lonlat = unproject(self.proj, np.column_stack((grid_x.ravel(),
+                                                       grid_y.ravel())))
+        errors = proj_errors(self.proj, lonlat[:, 1], lonlat[:, 0], R,
+                             self.angle)
+        return errors.reshape(grid_x.shape) / float(R)
+
+    def scale_error(self, x, y):
+        """Relative distance error at the projected point(s) (@x, @y).
+        Points outside of the sampled area get the error of the closest
+        point of its border
+        """
+        # fractional lattice coordinates
+        u = np.interp(x, self.xs, np.arange(len(self.xs)))
+        v = np.interp(y, self.ys, np.arange(len(self.ys)))
+        col = np.minimum(np.floor(u).astype(int), len(self.xs) - 2)
+        row = np.minimum(np.floor(v).astype(int), len(self.ys) - 2)
+        du = u - col
+        dv = v - row
+        top = (self.scale[row, col] * (1 - du) +
+               self.scale[row, col + 1] * du)
+        bottom = (self.scale[row + 1, col] * (1 - du) +
+                  self.scale[row + 1, col + 1] * du)
+        return top * (1 - dv) + bottom * dv
+
+    def error(self, x, y, R):
+        """Interpolated proj_error for the distance @R (in m) at the
+        projected point(s) (@x, @y)
+        """
+        return R * self.scale_error(x, y)
@@ -0,0 +1,409 @@
+"""Raster (occupancy grid) helpers for projected polygons
+"""
+from __future__ import absolute_import
+import math
+
+import numpy as np
+from shapely import vectorized
+from shapely.geometry import Point, box
+from shapely.ops import unary_union
+
+# default number of raster cells along the longest side of a polygon
+GRID_CELLS = 64
+
+# upper bound on the number of cells of a RasterRegion mask. This bounds
+# the cost of every operation on the region regardless of its size
+MAX_CELLS = 2 ** 21
+
+# fewest occupied cells a region is represented by. Regions that get fewer
+# at the default resolution, or that are split into several parts, are
+# rasterised part by part at a finer one
+MIN_POINTS = 16
+
+# number of candidate circle centres scored per numpy batch.
+# Keeps the (candidates x cells) distance matrix at a few MB
+BATCH = 256
+
+
+def cell_centres(bounds, resolution):
+    """Returns the coordinates of the cell centres (xs, ys) along each axis
+    of a grid with cells of size @resolution covering @bounds
+    """
+    (minx, miny, maxx, maxy) = bounds
+    # degenerate polygons still get a single cell
+    resolution = max(float(resolution), 1e-6)
+
+    cols = max(int(math.ceil((maxx - minx) / resolution)), 1)
+    rows = max(int(math.ceil((maxy - miny) / resolution)), 1)
+    xs = minx + (np.arange(cols) + 0.5) * resolution
+    ys = miny + (np.arange(rows) + 0.5) * resolution
+    return xs, ys, resolution
+
+
+def rasterize(poly, cells=GRID_CELLS, resolution=None):
+    """Rasterises a projected polygon into an occupancy grid
+
+    Args:
+        @poly:       polygon or multipolygon in PROJECTED coordinates
+        @cells:      number of cells along the longest side of the bounds
+        @resolution: size of each (square) cell in m. Overrides @cells
+
+    Returns:
+        (mask, xs, ys, resolution) where @mask is a boolean array of shape
+        (len(ys), len(xs)) and @xs, @ys hold the coordinates of the cell
+        centres along each axis
+    """
+    (minx, miny, maxx, maxy) = poly.bounds
+    if resolution is None:
+        resolution = max(maxx - minx, maxy - miny) / float(cells)
+    (xs, ys, resolution) = cell_centres(poly.bounds, resolution)
+
+    (grid_x, grid_y) = np.meshgrid(xs, ys)
+    mask = vectorized.contains(poly, grid_x, grid_y)
+    return mask, xs, ys, resolution
+
+
+def polygon_parts(poly):
+    """Returns the polygons @poly consists of
+    """
+    if poly.is_empty:
+        return []
+    if hasattr(poly, "geoms"):
+        return [part for part in poly.geoms if part.geom_type == "Polygon"]
+    if poly.geom_type == "Polygon":
+        return [poly]
+    return []
+
+
+def occupied_centres(poly, cells=GRID_CELLS, min_points=MIN_POINTS):
+    """Returns an (N, 2) array with the centres of all occupied raster cells
+    of @poly and the area of a single cell
+
+    A raster over the bounds of a region that is thin, or split into parts
+    far apart, may miss most of it. Such regions are rasterised part by
+    part, at a resolution fine enough for the smallest part to get about
+    @min_points cells, so that every part is represented in proportion to
+    its area. Parts too thin for any cell centre are represented by points
+    along their boundary, so callers always get a non empty set.
+    """
+    (mask, xs, ys, resolution) = rasterize(poly, cells)
+    (rows, cols) = np.nonzero(mask)
+    parts = polygon_parts(poly)
+    if len(rows) >= min_points and len(parts) <= 1:
+        return np.column_stack((xs[cols], ys[rows])), resolution * resolution
+    if len(parts) == 0:
+        point = poly.representative_point()
+        return np.array([[point.x, point.y]]), max(poly.area, 1.0)
+
+    smallest = min(part.area for part in parts)
+    fine = min(resolution, math.sqrt(smallest / float(min_points)))
+    # keep the total number of cells of all parts bounded
+    total = sum((p.bounds[2] - p.bounds[0]) * (p.bounds[3] - p.bounds[1])
+                for p in parts)
+    fine = max(fine, math.sqrt(total / float(4 * cells * cells)), 1e-3)
+
+    points = []
+    for part in parts:
+        (mask, xs, ys, _) = rasterize(part, resolution=fine)
+        (rows, cols) = np.nonzero(mask)
+        if len(rows) > 0:
+            points.append(np.column_stack((xs[cols], ys[rows])))
+            continue
+        ring = part.exterior
+        count = min(max(int(ring.length / fine), 1), cells)
+        points.append(np.array([ring.interpolate(d).coords[0] for d in
+                                np.linspace(0, ring.length, count,
+                                            endpoint=False)]))
+    return np.vstack(points), fine * fine
+
+
+def disk_counts(points, centres, R, weights=None):
+    """Evaluates the convolution of the occupancy grid with a disk kernel of
+    radius @R at each of @centres, i.e. counts how many of @points fall
+    inside each candidate disk.
+
+    Args:
+        @points:  (N, 2) array of occupied cell centres
+        @centres: (M, 2) array of candidate circle centres
+        @R:       radius of the disk kernel in m
+        @weights: optional array of N weights of the points, in which case
+                  the weights of the points inside each disk are summed
+
+    Returns:
+        an array of M counts
+    """
+    R2 = float(R) * R
+    p_norm = (points * points).sum(axis=1)
+    if weights is None:
+        counts = np.empty(len(centres), dtype=np.int64)
+    else:
+        counts = np.empty(len(centres))
+    for start in range(0, len(centres), BATCH):
+        chunk = centres[start:start + BATCH]
+        c_norm = (chunk * chunk).sum(axis=1)
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2
+        dist2 = c_norm[:, None] - 2 * np.dot(chunk, points.T) + p_norm[None, :]
+        if weights is None:
+            counts[start:start + BATCH] = (dist2 <= R2).sum(axis=1)
+        else:
+            counts[start:start + BATCH] = np.dot(dist2 <= R2, weights)
+    return counts
+
+
+def cut_candidates(points, R, directions=32, offsets=64):
+    """Creates candidate circle centres around the occupied cells @points
+
+    For every direction the circle centre slides along a ray through the
+    centre of mass, from a position where the circle swallows the whole
+    area to one where it barely touches it, so every direction contains
+    cuts of every size.
+
+    Returns:
+        an (directions * offsets, 2) array of centres
+    """
+    centre = points.mean(axis=0)
+    reach = math.sqrt(((points - centre) ** 2).sum(axis=1).max())
+    reach = max(reach, 1.0)
+
+    angles = 2 * math.pi * np.arange(directions) / float(directions)
+    steps = np.linspace(R - reach, R + reach, offsets)
+
+    unit = np.column_stack((np.cos(angles), np.sin(angles)))
+    centres = (centre[None, None, :] +
+               unit[:, None, :] * steps[None, :, None])
+    return centres.reshape(-1, 2)
+
+
+def binary_entropy(p):
+    """Entropy in bits of a Bernoulli variable with probability @p
+    """
+    p = np.clip(p, 1e-12, 1 - 1e-12)
+    return -(p * np.log2(p) + (1 - p) * np.log2(1 - p))
+
+
+def region_points(poly, cells=GRID_CELLS):
+    """Returns the occupied cell centres of a shapely (multi)polygon or a
+    RasterRegion, at most about @cells^2 of them
+    """
+    if isinstance(poly, RasterRegion):
+        return poly.centres(cells * cells)
+    return occupied_centres(poly, cells)[0]
+
+
+def best_cut(poly, R, cells=GRID_CELLS, directions=32, offsets=64):
+    """Returns the centre of the circle of radius @R (in m) that splits
+    the projected polygon @poly as close to half as possible, together with
+    the fraction of the area covered by that circle.
+
+    @poly may either be a shapely (multi)polygon or a RasterRegion
+    """
+    points = region_points(poly, cells)
+    centres = cut_candidates(points, R, directions, offsets)
+    counts = disk_counts(points, centres, R)
+
+    # the best cut is the one closest to an even split
+    diff = np.abs(counts - len(points) / 2.0)
+    best = int(np.argmin(diff))
+    fraction = counts[best] / float(len(points))
+    return [float(centres[best][0]), float(centres[best][1])], fraction
+
+
+def best_shared_cut(polys, R, cells=GRID_CELLS, directions=32, offsets=64):
+    """Returns the centre of the circle of radius @R (in m) that best cuts
+    all of @polys at once, together with the expected information (in bits)
+    of a query at that centre.
+
+    Each region is split by the circle into the part inside and the one
+    outside of it; the score of a candidate centre is the sum over all
+    regions of the entropy of that split, which is maximised when every
+    region is cut in half. Candidates are generated around every region.
+    """
+    points = [region_points(poly, cells) for poly in polys]
+    per_region = max(directions // len(points), 8)
+    centres = np.vstack([cut_candidates(p, R, per_region, offsets)
+                         for p in points])
+
+    score = np.zeros(len(centres))
+    for p in points:
+        score += binary_entropy(disk_counts(p, centres, R) / float(len(p)))
+
+    best = int(np.argmax(score))
+    return [float(centres[best][0]), float(centres[best][1])], score[best]
+
+
+def ring_remaining(points, centres, ring_range):
+    """Expected fraction of the occupied cells @points left after a ring
+    query from each of @centres
+
+    The victim is equally likely to be at any of @points. For a victim at
+    true distance d from a centre, the answer of the service yields the ring
+    of distances ring_range(d), and the cells whose distance from the centre
+    lies in that ring remain possible.
+
+    Args:
+        @points:     (N, 2) array of occupied cell centres
+        @centres:    (M, 2) array of candidate query positions
+        @ring_range: function mapping an array of true distances (in m) to
+                     the arrays (lo, hi) of the ring each yields, NaN where
+                     the service would give no answer
+
+    Returns:
+        (remaining, unanswered) arrays of M fractions: the expected fraction
+        of cells left and the fraction of cells for which there would be no
+        answer at all
+    """
+    remaining = np.empty(len(centres))
+    unanswered = np.empty(len(centres))
+    for (i, centre) in enumerate(centres):
+        dists = np.sqrt(((points - centre) ** 2).sum(axis=1))
+        (lo, hi) = ring_range(dists)
+        ordered = np.sort(dists)
+        missing = np.isnan(lo)
+        # cells within the ring of each possible victim location
+        left = (np.searchsorted(ordered, np.where(missing, 0, hi), "right") -
+                np.searchsorted(ordered, np.where(missing, 0, lo), "left"))
+        # no answer leaves every cell possible
+        left = np.where(missing, len(points), left)
+        remaining[i] = left.mean() / float(len(points))
+        unanswered[i] = missing.mean()
+    return remaining, unanswered
+
+
+class RasterRegion(object):
+    """Boolean mask representation of an active search region
+
+    The region is stored as a mask over a window of the plane, so that
+    intersecting or subtracting circles, computing the area and the centroid
+    are all vectorised operations on at most MAX_CELLS cells, independent of
+    how many steps have been applied so far. Whenever the region shrinks
+    enough, the window is cropped and re-rasterised at a finer resolution,
+    down to @resolution, by replaying the circles applied so far.
+
+    The area, centroid, bounds and is_empty attributes mirror the respective
+    shapely attributes so that the region can be used in place of a polygon.
+    """
+
+    def __init__(self, poly, resolution=1.0, max_cells=MAX_CELLS,
+                 constraints=None, window=None):
+        """Rasterises @poly
+
+        Args:
+            @poly:        projected polygon the region starts from
+            @resolution:  target size of each cell in m
+            @max_cells:   maximum number of cells in the mask
+            @constraints: circles (x, y, R, inside) already applied
+            @window:      bounds of the window to rasterise (defaults to the
+                          bounds of @poly)
+        """
+        self.poly = poly
+        self.resolution = float(resolution)
+        self.max_cells = max_cells
+        self.constraints = list(constraints) if constraints else []
+
+        (minx, miny, maxx, maxy) = window if window else poly.bounds
+        res = max(self.resolution,
+                  math.sqrt((maxx - minx) * (maxy - miny) / float(max_cells)))
+
+        (self.xs, self.ys, self.cell) = cell_centres((minx, miny, maxx, maxy),
+                                                     res)
+        (grid_x, grid_y) = np.meshgrid(self.xs, self.ys)
+        self.mask = vectorized.contains(poly, grid_x, grid_y)
+        for (x, y, R, inside) in self.constraints:
+            self.mask &= self._disk(x, y, R) == inside
+
+    def _disk(self, x, y, R):
+        """Returns a mask of the cells whose centres are within @R of (x, y)
+        """
+        dx2 = (self.xs - x) ** 2
+        dy2 = (self.ys - y) ** 2
+        return (dy2[:, None] + dx2[None, :]) <= float(R) * R
+
+    def _apply(self, x, y, R, inside):
+        """Returns a new region with the circle (x, y, R) applied
+        """
+        region = RasterRegion.__new__(RasterRegion)
+        region.__dict__.update(self.__dict__)
+        region.constraints = self.constraints + [(x, y, R, inside)]
+        region.mask = self.mask & (self._disk(x, y, R) == inside)
+        region._refine()
+        return region
+
+    def _refine(self):
+        """Crops the window to the occupied cells and re-rasterises it if
+        that allows for a resolution at least twice as fine
+        """
+        if self.cell <= self.resolution or self.is_empty:
+            return
+        (minx, miny, maxx, maxy) = self.bounds
+        res = max(self.resolution,
+                  math.sqrt((maxx - minx) * (maxy - miny) /
+                            float(self.max_cells)))
+        if res * 2 > self.cell:
+            return
+        fine = RasterRegion(self.poly, self.resolution, self.max_cells,
+                            self.constraints, self.bounds)
+        self.__dict__.update(fine.__dict__)
+
+    def intersect_circle(self, x, y, R):
+        """Returns the part of the region inside the circle (x, y, R)
+        """
+        return self._apply(x, y, R, True)
+
+    def difference_circle(self, x, y, R):
+        """Returns the part of the region outside the circle (x, y, R)
+        """
+        return self._apply(x, y, R, False)
+
+    @property
+    def is_empty(self):
+        return not self.mask.any()
+
+    @property
+    def area(self):
+        return self.mask.sum() * self.cell * self.cell
+
+    @property
+    def bounds(self):
+        """Bounds of the occupied cells, (minx, miny, maxx, maxy)
+        """
+        (rows, cols) = np.nonzero(self.mask)
+        if len(rows) == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+        half = self.cell / 2
+        return (self.xs[cols.min()] - half, self.ys[rows.min()] - half,
+                self.xs[cols.max()] + half, self.ys[rows.max()] + half)
+
+    @property
+    def centroid(self):
+        (rows, cols) = np.nonzero(self.mask)
+        if len(rows) == 0:
+            return Point()
+        return Point(self.xs[cols].mean(), self.ys[rows].mean())
+
+    def centres(self, max_points=None):
+        """Returns an (N, 2) array of the centres of the occupied cells.
+
+        If @max_points is given the mask is subsampled with a regular stride
+        so that roughly at most @max_points centres are returned.
+        """
+        (rows, cols) = np.nonzero(self.mask)
+        if max_points is not None and len(rows) > max_points:
+            stride = int(math.ceil(math.sqrt(len(rows) / float(max_points))))
+            keep = (rows % stride == 0) & (cols % stride == 0)
+            if keep.any():
+                (rows, cols) = (rows[keep], cols[keep])
+        return np.column_stack((self.xs[cols], self.ys[rows]))
+
+    def to_polygon(self):
+        """Converts the region to a shapely (multi)polygon by merging the
+        runs of occupied cells of each row
+        """
+        half = self.cell / 2
+        boxes = []
+        for (row, y) in enumerate(self.ys):
+            line = np.concatenate(([False], self.mask[row], [False]))
+            edges = np.flatnonzero(line[1:] != line[:-1])
+            for (start, end) in zip(edges[::2], edges[1::2]):
+                boxes.append(box(self.xs[start] - half, y - half,
+                                 self.xs[end - 1] + half, y + half))
+        return unary_union(boxes)